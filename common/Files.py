@@ -0,0 +1,19 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os
+import tempfile
+
+def write_atomically(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import threading
+from contextlib import contextmanager
+
+class RWLock(object):
+    ''' A writer-preferring reader/writer lock.
+
+    Any number of readers may hold the lock at once; a writer holds it alone.
+    The thread holding the write lock may re-acquire it, and may also take
+    the read lock, so that code called from under a writer does not deadlock.
+    '''
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+        self.waiting_writers = 0
+
+    def acquire_read(self, blocking = True):
+        me = threading.current_thread()
+        with self.cond:
+            if self.writer is me:
+                self.depth += 1
+                return True
+            if not blocking:
+                if self.writer is not None:
+                    return False
+            else:
+                while self.writer is not None or self.waiting_writers:
+                    self.cond.wait()
+            self.readers += 1
+            return True
+
+    def release_read(self):
+        with self.cond:
+            if self.writer is threading.current_thread():
+                self.depth -= 1
+                return
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self.cond:
+            if self.writer is me:
+                self.depth += 1
+                return True
+            self.waiting_writers += 1
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = me
+            self.depth = 1
+            return True
+
+    def release_write(self):
+        with self.cond:
+            self.depth -= 1
+            if self.depth == 0:
+                self.writer = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield self
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield self
+        finally:
+            self.release_write()
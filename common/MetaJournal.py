@@ -0,0 +1,239 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os
+import re
+import json
+import zlib
+import threading
+
+from Files import write_atomically
+from NameTrie import *
+from Trace import *
+
+COMMIT_INTERVAL = 0.05 # seconds
+COMMIT_BATCH = 1024 # records
+COMPACT_RECORDS = 64 * 1024
+SNAPSHOT = "snapshot"
+LOG_PATTERN = re.compile(r"^log\.(\d+)$")
+
+# Paths are byte strings in no particular encoding; latin-1 maps every
+# byte to a code point and back.
+def to_json(value):
+    return json.dumps(value, separators=(",", ":"), encoding="latin-1")
+
+def name_of(value):
+    return value.encode("latin-1") if isinstance(value, unicode) else value
+
+def encode_record(record):
+    body = to_json(record)
+    return "%08x %s\n" % (zlib.crc32(body) & 0xffffffff, body)
+
+def decode_record(line):
+    ''' Return the record on `line`, or None if it is torn or corrupt.
+    '''
+    if not line.endswith("\n") or len(line) < 10 or line[8] != " ":
+        return None
+    body = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(body) & 0xffffffff:
+            return None
+        record = json.loads(body)
+    except ValueError:
+        return None
+    return [name_of(field) for field in record]
+
+class MetaJournal(threading.Thread):
+    ''' Durable file attributes (mode, owner, times) keyed by path.
+
+    Changes are applied to an in-memory table at once and appended to a log
+    in batches: the commit thread writes whatever accumulated during the
+    last `interval` (or COMMIT_BATCH records, whichever comes first) with a
+    single write and fsync. sync() waits until every change made before it
+    is durable. Once a log holds `compact_records` records the table is
+    written out as a snapshot and a new log started.
+
+    Every snapshot carries a generation, and the log continuing it is named
+    log.<generation>. At mount the snapshot is loaded and the logs from its
+    generation on are replayed, stopping at the first torn record.
+
+    If a commit fails the journal stops writing: nothing after the failed
+    batch could be replayed anyway. Every sync() from then on raises.
+    '''
+    def __init__(self, directory, interval = COMMIT_INTERVAL, compact_records = COMPACT_RECORDS, thread_name = "journal"):
+        super(MetaJournal, self).__init__(name = thread_name)
+        self.daemon = True
+        self.directory = directory
+        self.interval = interval
+        self.compact_records = compact_records
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.table = NameTrie()
+        self.pending = []
+        self.syncing = 0
+        self.queued = 0
+        self.durable = 0
+        self.error = None
+        self.cond = threading.Condition()
+        self.running = True
+        self.generation = self.recover()
+        self.log = open(self._log_path(self.generation), "ab")
+        self.logged = 0
+        self.start()
+
+    def _log_path(self, generation):
+        return os.path.join(self.directory, "log.%d" % (generation))
+
+    def recover(self):
+        ''' Rebuild the table and compact it; return the new generation.
+        '''
+        generation = 0
+        path = os.path.join(self.directory, SNAPSHOT)
+        if os.path.isfile(path):
+            with open(path, "rb") as fh:
+                snapshot = json.load(fh)
+            generation = snapshot["generation"]
+            for name, attrs in snapshot["table"]:
+                self.table[name_of(name)] = attrs
+        logs = sorted(int(match.group(1)) for match in map(LOG_PATTERN.match, os.listdir(self.directory)) if match)
+        for log in logs:
+            if log >= generation:
+                self.replay(self._log_path(log))
+        generation = max(logs + [generation]) + 1
+        self.write_snapshot(generation, self.table.items())
+        for log in logs:
+            os.unlink(self._log_path(log))
+        return generation
+
+    def replay(self, path):
+        with open(path, "rb") as fh:
+            for line in fh:
+                record = decode_record(line)
+                if record is None:
+                    TRACER.warn("%s: ignoring a torn record and everything after it", path)
+                    return
+                self.apply(record)
+
+    def apply(self, record):
+        ''' Apply one record to the table. Must be called with the condition
+        held (or before the commit thread starts).
+        '''
+        op = record[0]
+        if op == "set":
+            attrs = self.table.get(record[1])
+            if attrs is None:
+                attrs = self.table[record[1]] = {}
+            attrs.update(record[2])
+        elif op == "remove":
+            self.table.pop_prefix(record[1])
+        elif op == "rename":
+            old, new = record[1], record[2]
+            self.table.pop_prefix(new)
+            for name, attrs in self.table.pop_prefix(old):
+                self.table[new + name[len(old):]] = attrs
+
+    def write_snapshot(self, generation, table):
+        write_atomically(os.path.join(self.directory, SNAPSHOT), to_json({"generation": generation, "table": table}))
+
+    def record(self, record):
+        with self.cond:
+            self.apply(record)
+            self.pending.append(record)
+            self.queued += 1
+            if len(self.pending) == 1 or len(self.pending) >= COMMIT_BATCH:
+                self.cond.notify_all()
+
+    def get(self, name):
+        ''' Return a copy of the recorded attributes of `name`, or None.
+        '''
+        with self.cond:
+            attrs = self.table.get(name)
+            return dict(attrs) if attrs is not None else None
+
+    def update(self, name, **attrs):
+        self.record(["set", name, attrs])
+
+    def remove(self, name):
+        ''' Forget `name` and everything below it.
+        '''
+        self.record(["remove", name])
+
+    def rename(self, old, new):
+        ''' Move the attributes of `old`, and everything below it, to `new`.
+        '''
+        self.record(["rename", old, new])
+
+    def sync(self):
+        ''' Return once every change recorded so far is durable.
+        '''
+        with self.cond:
+            target = self.queued
+            self.syncing += 1
+            self.cond.notify_all()
+            while self.durable < target and self.is_alive() and self.error is None:
+                self.cond.wait(self.interval)
+            self.syncing -= 1
+            if self.durable < target:
+                raise Exception("metadata journal is not durable: %s" % (self.error))
+
+    def stop(self):
+        ''' Commit everything still pending and wait for the thread to exit.
+        '''
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.join()
+        self.log.close()
+
+    def commit(self, batch):
+        self.log.write("".join(encode_record(record) for record in batch))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.logged += len(batch)
+
+    def compact(self, table):
+        ''' Start a new log and snapshot `table`, the state the old log
+        ends in. Until the snapshot is in place, recovery replays both logs.
+        '''
+        generation = self.generation + 1
+        old = self._log_path(self.generation)
+        self.log.close()
+        self.log = open(self._log_path(generation), "ab")
+        self.generation = generation
+        self.logged = 0
+        self.write_snapshot(generation, table)
+        os.unlink(old)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                # Let a batch gather unless someone is waiting for it.
+                if self.running and len(self.pending) < COMMIT_BATCH and not self.syncing:
+                    self.cond.wait(self.interval)
+                batch, self.pending = self.pending, []
+                running = self.running
+                # Copied with the batch, the table is exactly the state the
+                # log will be in once the batch is committed.
+                table = None
+                if batch and (self.logged + len(batch) >= self.compact_records or not running):
+                    table = [(name, dict(attrs)) for name, attrs in self.table.items()]
+            committed = False
+            if batch and self.error is None:
+                try:
+                    self.commit(batch)
+                    committed = True
+                    if table is not None:
+                        self.compact(table)
+                except Exception as e:
+                    TRACER.error("metadata journal commit failed: %s", e)
+                    with self.cond:
+                        self.error = e
+            with self.cond:
+                if committed:
+                    self.durable += len(batch)
+                self.cond.notify_all()
+                if not running and not self.pending:
+                    return
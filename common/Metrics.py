@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Histograms bucket microseconds log-linearly: every power of two is split
+# into SUB_BUCKETS equal buckets, so a recorded value is off by at most
+# 1/SUB_BUCKETS of itself whatever its magnitude.
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+PERCENTILES = (50, 90, 99, 99.9)
+
+def bucket_of(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BITS - 1
+    return ((shift + 1) << SUB_BITS) + (value >> shift) - SUB_BUCKETS
+
+def bucket_ceiling(bucket):
+    ''' The largest value counted in `bucket`.
+    '''
+    if bucket < SUB_BUCKETS:
+        return bucket
+    shift = (bucket >> SUB_BITS) - 1
+    return (((bucket & (SUB_BUCKETS - 1)) + SUB_BUCKETS + 1) << shift) - 1
+
+class Histogram(object):
+    ''' An HDR-style latency histogram in microseconds. Recording is a dict
+    increment, and memory is bounded by the number of distinct buckets hit
+    (at most SUB_BUCKETS per power of two).
+    '''
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, micros):
+        micros = int(micros)
+        bucket = bucket_of(micros)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += micros
+        if micros > self.max:
+            self.max = micros
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        rank = self.count * p / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(bucket_ceiling(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        summary = {"count": self.count, "max_us": self.max,
+                   "mean_us": self.total // self.count if self.count else 0}
+        for p in PERCENTILES:
+            summary["p%s_us" % (p)] = self.percentile(p)
+        return summary
+
+class Metrics(object):
+    ''' Counters and latency histograms for one mount, plus gauges: callables
+    sampled only when a snapshot is taken. Updates take one short lock, so
+    metrics can stay enabled in production.
+    '''
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(seconds * 1e6)
+
+    @contextmanager
+    def timing(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def gauge(self, name, sample):
+        self.gauges[name] = sample
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {
+                "uptime_s": round(time.time() - self.started, 3),
+                "counters": dict(self.counters),
+                "latency": dict((name, histogram.summary()) for name, histogram in self.histograms.items()),
+            }
+        snapshot["gauges"] = dict((name, sample()) for name, sample in self.gauges.items())
+        return snapshot
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1, sort_keys=True)
+
+class NullMetrics(Metrics):
+    ''' Discards everything; the default for objects nobody is measuring.
+    '''
+    def count(self, name, amount = 1):
+        pass
+
+    def record(self, name, seconds):
+        pass
+
+NULL_METRICS = NullMetrics()
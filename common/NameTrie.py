@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+def components(name):
+    ''' Split a path or CCNx name into its non-empty segments.
+    '''
+    return [segment for segment in name.split("/") if segment]
+
+class TrieNode(object):
+    __slots__ = ("children", "name", "value", "has_value")
+
+    def __init__(self):
+        self.children = {}
+        self.name = None
+        self.value = None
+        self.has_value = False
+
+class NameTrie(object):
+    ''' A dict-like map from names to values, stored as a tree of name
+    segments so that everything under a prefix can be listed or removed in
+    time proportional to the size of that subtree rather than the whole map.
+    '''
+    def __init__(self):
+        self.root = TrieNode()
+        self.count = 0
+
+    def _path(self, name, create = False):
+        ''' Return the list of nodes from the root down to `name`, or None if
+        it is missing and `create` is not set.
+        '''
+        node = self.root
+        path = [node]
+        for segment in components(name):
+            child = node.children.get(segment)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[segment] = TrieNode()
+            node = child
+            path.append(node)
+        return path
+
+    def _node(self, name):
+        path = self._path(name)
+        return path[-1] if path is not None else None
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, name):
+        node = self._node(name)
+        return node is not None and node.has_value
+
+    def __getitem__(self, name):
+        node = self._node(name)
+        if node is None or not node.has_value:
+            raise KeyError(name)
+        return node.value
+
+    def __setitem__(self, name, value):
+        node = self._path(name, True)[-1]
+        if not node.has_value:
+            self.count += 1
+        node.name = name
+        node.value = value
+        node.has_value = True
+
+    def __delitem__(self, name):
+        self.pop(name)
+
+    def __iter__(self):
+        return (name for name, value in self.items())
+
+    def get(self, name, default = None):
+        node = self._node(name)
+        if node is None or not node.has_value:
+            return default
+        return node.value
+
+    def pop(self, name, *default):
+        path = self._path(name)
+        if path is None or not path[-1].has_value:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        node = path[-1]
+        value = node.value
+        node.value = None
+        node.name = None
+        node.has_value = False
+        self.count -= 1
+        self._prune(path, components(name))
+        return value
+
+    def _prune(self, path, segments):
+        ''' Remove now-empty nodes at the end of `path`.
+        '''
+        for depth in range(len(segments), 0, -1):
+            node = path[depth]
+            if node.has_value or node.children:
+                break
+            del path[depth - 1].children[segments[depth - 1]]
+
+    def items(self, prefix = "/"):
+        ''' Return the (name, value) pairs at or below `prefix`.
+        '''
+        node = self._node(prefix)
+        found = []
+        stack = [node] if node is not None else []
+        while stack:
+            node = stack.pop()
+            if node.has_value:
+                found.append((node.name, node.value))
+            stack.extend(node.children.values())
+        return found
+
+    def children(self, prefix = "/"):
+        ''' Return the names of the segments immediately below `prefix`.
+        '''
+        node = self._node(prefix)
+        if node is None:
+            return []
+        return sorted(node.children)
+
+    def pop_prefix(self, prefix):
+        ''' Remove and return every (name, value) pair at or below `prefix`.
+        '''
+        found = self.items(prefix)
+        segments = components(prefix)
+        if not segments:
+            self.root = TrieNode()
+            self.count = 0
+            return found
+        path = self._path(prefix)
+        if path is not None:
+            del path[-2].children[segments[-1]]
+            self.count -= len(found)
+            self._prune(path[:-1], segments[:-1])
+        return found
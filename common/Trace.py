@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import sys
+import time
+import zlib
+import random
+import struct
+import threading
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+OFF = 100
+LEVELS = {"debug": DEBUG, "info": INFO, "warn": WARN, "error": ERROR, "off": OFF}
+
+RING_SIZE = 4096
+# time, op code, path id, offset, length, duration in microseconds
+RECORD = struct.Struct("<dBIqII")
+
+def path_id(path):
+    return zlib.crc32(path) & 0xffffffff
+
+def display_args(args):
+    ''' Describe an operation's arguments, abbreviating data buffers.
+    '''
+    return ", ".join("<%d bytes>" % (len(arg)) if isinstance(arg, str) and len(arg) > 64 else repr(arg)
+                     for arg in args)
+
+def extent_of(op, args):
+    ''' The (offset, length) an operation touched, from its FUSE
+    arguments.
+    '''
+    if op == "read":
+        return args[2], args[1]
+    if op == "write":
+        return args[2], len(args[1])
+    if op == "truncate":
+        return args[1], 0
+    return 0, 0
+
+class Tracer(object):
+    ''' Leveled, sampled log messages plus a fixed-size binary ring of the
+    most recent operations.
+
+    Every message is checked against the level (and the sampling rate)
+    before it is formatted, so a disabled message costs one comparison. The
+    ring is a preallocated bytearray written with struct.pack_into; dump()
+    decodes it on demand.
+    '''
+    def __init__(self, level = WARN, sample = 1.0, ring_size = RING_SIZE, stream = None):
+        self.stream = stream or sys.stderr
+        self.configure(level, sample, ring_size)
+
+    def configure(self, level = WARN, sample = 1.0, ring_size = RING_SIZE):
+        self.level = level
+        self.sample = sample
+        self.ring_size = ring_size
+        self.ring = bytearray(RECORD.size * ring_size)
+        self.next = 0
+        self.ops = {}
+        self.op_names = []
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def enabled(self, level):
+        return level >= self.level and (self.sample >= 1.0 or random.random() < self.sample)
+
+    def log(self, level, message, *args):
+        if self.enabled(level):
+            self.emit(message % args if args else message)
+
+    def emit(self, message):
+        self.stream.write("%.6f %s %s\n" % (time.time(), threading.current_thread().name, message))
+
+    def debug(self, message, *args):
+        if DEBUG >= self.level:
+            self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        if INFO >= self.level:
+            self.log(INFO, message, *args)
+
+    def warn(self, message, *args):
+        if WARN >= self.level:
+            self.log(WARN, message, *args)
+
+    def error(self, message, *args):
+        if ERROR >= self.level:
+            self.log(ERROR, message, *args)
+
+    def record(self, op, path, offset, length, duration):
+        ''' Append one operation to the ring, overwriting the oldest.
+        '''
+        if not self.ring_size or (self.sample < 1.0 and random.random() >= self.sample):
+            return
+        with self.lock:
+            code = self.ops.get(op)
+            if code is None:
+                code = self.ops[op] = len(self.op_names)
+                self.op_names.append(op)
+            ident = path_id(path)
+            if ident not in self.paths:
+                if len(self.paths) >= 4 * self.ring_size:
+                    self.paths.clear()
+                self.paths[ident] = path
+            slot = self.next % self.ring_size
+            self.next += 1
+            RECORD.pack_into(self.ring, slot * RECORD.size, time.time(), code, ident,
+                             offset, length, min(int(duration * 1e6), 0xffffffff))
+
+    def dump(self):
+        ''' Return the recorded operations, oldest first.
+        '''
+        with self.lock:
+            count = min(self.next, self.ring_size)
+            first = self.next - count
+            records = [RECORD.unpack_from(self.ring, (index % self.ring_size) * RECORD.size)
+                       for index in range(first, self.next)]
+            names = list(self.op_names)
+            paths = dict(self.paths)
+        return [{"time": stamp, "op": names[code], "path": paths.get(ident, ident),
+                 "offset": offset, "length": length, "duration_us": duration}
+                for stamp, code, ident, offset, length, duration in records]
+
+    def dump_text(self):
+        return "".join("%.6f %-10s %s %d %d %dus\n" % (entry["time"], entry["op"], entry["path"],
+                                                      entry["offset"], entry["length"], entry["duration_us"])
+                       for entry in self.dump())
+
+TRACER = Tracer()
@@ -0,0 +1,7 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+''' Modules shared by enfs and the CCNx drive in src. Each program's
+directory links to this one as `common`.
+'''
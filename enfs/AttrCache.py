@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import time
+import threading
+
+ATTR_TTL = 1.0
+
+def parent_of(path):
+    parent = path.rsplit("/", 1)[0]
+    return parent or "/"
+
+class AttrCache(object):
+    ''' TTL cache of getattr results and directory listings, keyed by mount
+    path. Entries expire after `ttl` seconds and are dropped early by
+    invalidate() whenever the file system itself changes a path.
+    '''
+    def __init__(self, ttl = ATTR_TTL):
+        self.ttl = ttl
+        self.attrs = {}
+        self.dirs = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _get(self, table, path):
+        with self.lock:
+            entry = table.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.time():
+                del table[path]
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def get_attr(self, path):
+        return self._get(self.attrs, path)
+
+    def put_attr(self, path, attrs):
+        with self.lock:
+            self.attrs[path] = (time.time() + self.ttl, attrs)
+
+    def get_dir(self, path):
+        return self._get(self.dirs, path)
+
+    def put_dir(self, path, entries):
+        with self.lock:
+            self.dirs[path] = (time.time() + self.ttl, entries)
+
+    def invalidate(self, path, entry_changed = False):
+        ''' Forget the attributes of `path`; when a name was added to or
+        removed from its directory, forget the parent's listing too.
+        '''
+        with self.lock:
+            self.attrs.pop(path, None)
+            self.dirs.pop(path, None)
+            if entry_changed:
+                parent = parent_of(path)
+                self.dirs.pop(parent, None)
+                self.attrs.pop(parent, None)
+
+    def invalidate_tree(self, path):
+        ''' Forget `path`, its parent's listing and everything below it. '''
+        prefix = path.rstrip("/") + "/"
+        self.invalidate(path, True)
+        with self.lock:
+            for table in (self.attrs, self.dirs):
+                for key in [key for key in table if key.startswith(prefix)]:
+                    del table[key]
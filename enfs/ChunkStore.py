@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os
+import json
+import hashlib
+import threading
+
+from common.Files import write_atomically
+
+# A deduplicated file's backing file holds only this magic line followed by
+# a JSON manifest: its size, chunk size and the SHA-256 of every chunk. A run
+# of chunks that were never written (holes) is stored as its length.
+MANIFEST_MAGIC = "ENFSCAS2\n"
+# Version 1 manifests list a null for every chunk never written; they are
+# still read, and rewritten as version 2 the next time the file is saved.
+MANIFEST_MAGIC_V1 = "ENFSCAS1\n"
+
+def encode_manifest(size, chunk_size, chunks):
+    encoded = []
+    for digest in chunks:
+        if digest is not None:
+            encoded.append(digest)
+        elif encoded and isinstance(encoded[-1], int):
+            encoded[-1] += 1
+        else:
+            encoded.append(1)
+    return MANIFEST_MAGIC + json.dumps({"size": size, "chunk_size": chunk_size, "chunks": encoded}, separators=(",", ":"))
+
+def read_manifest(path):
+    ''' Return the manifest stored at `path`, or None if it holds plain data.
+    '''
+    with open(path, "rb") as fh:
+        magic = fh.read(len(MANIFEST_MAGIC))
+        if magic not in (MANIFEST_MAGIC, MANIFEST_MAGIC_V1):
+            return None
+        manifest = json.loads(fh.read())
+    chunks = []
+    for entry in manifest["chunks"]:
+        if entry is None and magic == MANIFEST_MAGIC_V1:
+            chunks.append(None)
+        elif isinstance(entry, int) and magic == MANIFEST_MAGIC:
+            chunks.extend([None] * entry)
+        elif isinstance(entry, basestring):
+            chunks.append(str(entry))
+        else:
+            raise ValueError("%s: bad manifest entry %r" % (path, entry))
+    manifest["chunks"] = chunks
+    return manifest
+
+class ChunkStore(object):
+    ''' Chunks stored once by SHA-256 under `directory`, reference counted
+    by the manifests that list them.
+
+    Reference counts are rebuilt by scanning the manifests under `root` when
+    the store opens; any chunk no manifest refers to is deleted then.
+    '''
+    def __init__(self, directory, root, skip = ()):
+        self.directory = directory
+        self.refs = {}
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.scan(root, skip)
+        self.sweep()
+
+    def chunk_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def scan(self, root, skip):
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath == root:
+                dirnames[:] = [name for name in dirnames if name not in skip]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.lstat(path)
+                    if (st.st_dev, st.st_ino) in seen or not os.path.isfile(path):
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                    manifest = read_manifest(path)
+                except (IOError, OSError, ValueError):
+                    continue
+                if manifest is not None:
+                    self.acquire(manifest["chunks"])
+
+    def sweep(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for digest in filenames:
+                if digest not in self.refs:
+                    os.unlink(os.path.join(dirpath, digest))
+
+    def get(self, digest):
+        with open(self.chunk_path(digest), "rb") as fh:
+            return fh.read()
+
+    def put(self, data):
+        ''' Store `data` unless an identical chunk is already stored, and
+        return its digest. The caller holds one reference to the chunk until
+        it releases it.
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        self.acquire([digest])
+        path = self.chunk_path(digest)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass # already there
+            write_atomically(path, data)
+        return digest
+
+    def acquire(self, digests):
+        with self.lock:
+            for digest in digests:
+                if digest is not None:
+                    self.refs[digest] = self.refs.get(digest, 0) + 1
+
+    def release(self, digests):
+        ''' Drop one reference to each of `digests`, deleting chunks that are
+        no longer referenced.
+        '''
+        with self.lock:
+            for digest in digests:
+                if digest is None:
+                    continue
+                count = self.refs.get(digest, 0) - 1
+                if count > 0:
+                    self.refs[digest] = count
+                    continue
+                self.refs.pop(digest, None)
+                try:
+                    os.unlink(self.chunk_path(digest))
+                except OSError:
+                    pass
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import bz2
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Codec ids as recorded in a chunk header's flags byte.
+NONE, ZLIB, BZ2, LZMA = range(4)
+CODEC_MASK = 0x0f
+
+CODECS = {"zlib": ZLIB, "bz2": BZ2}
+if lzma is not None:
+    CODECS["lzma"] = LZMA
+
+# A compressed chunk is only kept if it is at most this fraction of the
+# plaintext; anything less is not worth decompressing on every read.
+MAX_RATIO = 0.875
+
+def codec_of(name):
+    ''' The codec id for a codec name, or NONE for None.
+    '''
+    if name is None:
+        return NONE
+    if name not in CODECS:
+        raise Exception("Unknown or unavailable compression codec %s" % (name))
+    return CODECS[name]
+
+def compress(codec, data):
+    if codec == ZLIB:
+        return zlib.compress(data, 6)
+    if codec == BZ2:
+        return bz2.compress(data, 9)
+    if codec == LZMA and lzma is not None:
+        return lzma.compress(data)
+    raise Exception("Unknown compression codec %d" % (codec))
+
+def decompress(codec, data, length):
+    ''' Decompress `data`, which must expand to exactly `length` bytes.
+    '''
+    if codec == ZLIB:
+        plaintext = zlib.decompress(data)
+    elif codec == BZ2:
+        plaintext = bz2.decompress(data)
+    elif codec == LZMA and lzma is not None:
+        plaintext = lzma.decompress(data)
+    else:
+        raise Exception("Unknown compression codec %d" % (codec))
+    if len(plaintext) != length:
+        raise Exception("Chunk decompressed to %d bytes, not %d" % (len(plaintext), length))
+    return plaintext
+
+def compress_chunk(codec, plaintext, overhead = 0):
+    ''' Return (codec, payload) for one chunk: the compressed payload, or
+    (NONE, plaintext) if the chunk does not compress well enough with
+    `overhead` bytes of framing added.
+    '''
+    if codec == NONE or not plaintext:
+        return NONE, plaintext
+    payload = compress(codec, plaintext)
+    if len(payload) + overhead > len(plaintext) * MAX_RATIO:
+        return NONE, plaintext
+    return codec, payload
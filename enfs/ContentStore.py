@@ -7,19 +7,77 @@ import os.path
 import sys
 import errno
 import argparse
-# import time
+import time
 import tempfile
 import json
 import stat
+import threading
+import collections
 
 from FileHandle import *
+from PageCache import *
+from Flusher import *
+from common.NameTrie import *
+from common.Trace import *
+from OpenFiles import *
+from common.Metrics import *
+from common.MetaJournal import *
+from WriteAheadLog import *
+
+# Store-private state (key salt, caches, logs) lives under this directory
+# of the root and is hidden from the mount.
+META_DIR = ".enfs"
 
 class ContentStore(object):
-    def __init__(self, root):
+    def __init__(self, root, cache_bytes = DEFAULT_CACHE_BYTES, passphrase = None, key_cache_size = KEY_CACHE_SIZE,
+                 crypto_workers = None, writeback_delay = 0, dirty_limit = DIRTY_LIMIT, dedup = False,
+                 use_mmap = False, prefetch_workers = PREFETCH_WORKERS, max_idle_files = MAX_IDLE_FILES,
+                 wal = False, compression = None):
         self.root = root
-        self.files = {} # root is always in there...
-        self.handles = {}
-        self.descriptor_seq = 0
+        self._meta_path("")
+        self.metrics = Metrics()
+        self.journal = MetaJournal(self._meta_path("journal"), thread_name = "enfs-journal")
+        if dedup and passphrase is not None:
+            raise Exception("Deduplication cannot be combined with encryption")
+        if wal and (dedup or use_mmap):
+            raise Exception("The write-ahead log cannot be combined with deduplication or memory maps")
+        if compression is not None and passphrase is None:
+            raise Exception("Compression needs the chunked format of encrypted files")
+        self.codec = codec_of(compression)
+        # Redo whatever a crash left in the log, whether or not this mount
+        # keeps one.
+        recover_log(self._meta_path("wal"), root)
+        self.wal = WriteAheadLog(self._meta_path("wal"), metrics = self.metrics) if wal else None
+        self.use_mmap = use_mmap
+        self.chunk_store = None
+        if dedup:
+            self.chunk_store = ChunkStore(self._meta_path("chunks"), root, (META_DIR,))
+        self.keys = None
+        self.crypto_pool = None
+        if passphrase is not None:
+            self.keys = KeyCache(self.derive_master_key(passphrase), key_cache_size)
+            self.crypto_pool = CryptoPool(crypto_workers)
+        self.flusher = None
+        if writeback_delay > 0:
+            self.flusher = Flusher(writeback_delay, dirty_limit)
+            self.flusher.start()
+        self.page_cache = PageCache(cache_bytes)
+        self.prefetcher = Prefetcher(prefetch_workers) if prefetch_workers > 0 else None
+        # `files` holds a handle per known file (its inode: metadata and
+        # cached data), `open_files` a descriptor per open. Handles no
+        # descriptor refers to are kept in `idle`, least recently used
+        # first, and forgotten beyond `max_idle_files`.
+        self.files = NameTrie()
+        self.open_files = OpenFileTable()
+        self.idle = collections.OrderedDict()
+        self.max_idle_files = max_idle_files
+        self.inode_seq = 0
+        # Guards the namespace (files, open_files, idle); per-file data is
+        # protected by each FileHandle's own reader/writer lock.
+        self.lock = threading.RLock()
+        self.metrics.gauge("page_cache_bytes", lambda: self.page_cache.used)
+        self.metrics.gauge("open_files", lambda: len(self.open_files))
+        self.metrics.gauge("known_files", lambda: len(self.files))
 
     def _full_path(self, path):
         if path.startswith("/"):
@@ -27,98 +85,354 @@ class ContentStore(object):
         path = os.path.join(self.root, path)
         return path
 
+    def _meta_path(self, name):
+        meta = os.path.join(self.root, META_DIR)
+        if not os.path.isdir(meta):
+            os.makedirs(meta)
+        return os.path.join(meta, name)
+
+    def derive_master_key(self, passphrase):
+        ''' Run the slow passphrase KDF once per mount; its salt is kept in
+        the store so the same passphrase always yields the same master key.
+        '''
+        path = self._meta_path("salt")
+        if os.path.isfile(path):
+            with open(path, "rb") as fh:
+                salt = fh.read()
+        else:
+            salt = os.urandom(SALT_SIZE)
+            with open(path, "wb") as fh:
+                fh.write(salt)
+        return KDF().derive(passphrase, salt)
+
     def contains_handle(self, fid):
-        return fid in self.handles
+        with self.lock:
+            return fid in self.open_files
 
     def contains_file(self, name):
-        return name in self.files
+        with self.lock:
+            return name in self.files
 
     def load(self, name):
-        return self.files[name].load()
+        return self.get_handle_from_path(name).load()
 
     def open(self, name, flags):
-        print "CS OPEN %s" % (name)
+        TRACER.debug("open %s", name)
         fullpath = self._full_path(name)
-        if name in self.files:
-            print "loading old copy"
-            return self.files[name].load().fid
-        elif os.path.isfile(fullpath):
-            access_mode = os.R_OK | os.W_OK | os.X_OK
-            return self.create_local_file(name, access_mode).load().fid
-        else:
-            return self.create_remote_file(name).load().fid
+        with self.lock:
+            if name in self.files:
+                handle = self.files[name]
+            elif os.path.isfile(fullpath):
+                access_mode = os.R_OK | os.W_OK | os.X_OK
+                handle = self.create_local_file(name, access_mode)
+            else:
+                handle = self.create_remote_file(name)
+            fid = self._open(name, handle, flags)
+        return self._load(fid)
+
+    def create(self, name, mode, flags = os.O_RDWR):
+        ''' Create (or reuse) the file `name` and open it.
+        '''
+        with self.lock:
+            fid = self._open(name, self.create_local_file(name, mode), flags)
+        return self._load(fid)
+
+    def _open(self, name, handle, flags):
+        self.idle.pop(name, None)
+        return self.open_files.open(handle, flags)
+
+    def _load(self, fid):
+        try:
+            handle = self.get_handle(fid)
+            loaded = handle.is_loaded
+            handle.load()
+            if not loaded:
+                self.restore_times(handle)
+        except:
+            with self.lock:
+                self.open_files.release(fid)
+            raise
+        return fid
+
+    def restore_times(self, handle):
+        ''' Times set with utime() outlive the backing file's own.
+        '''
+        attrs = self.journal.get(handle.name)
+        if attrs is not None and "mtime" in attrs:
+            handle.times = (attrs["atime"], attrs["mtime"])
+
+    def release(self, fid):
+        ''' Drop the descriptor `fid`; closing the last descriptor of a file
+        unloads its data and leaves only its (evictable) metadata.
+        '''
+        with self.lock:
+            handle = self.open_files.release(fid).handle
+            last = self.open_files.count(handle) == 0 and self.files.get(handle.name) is handle
+            if last:
+                self.idle.pop(handle.name, None)
+                self.idle[handle.name] = handle
+        if last:
+            # Keep journaled times current once the file has been written.
+            attrs = self.journal.get(handle.name)
+            if attrs is not None and "mtime" in attrs and (attrs["atime"], attrs["mtime"]) != tuple(handle.times):
+                self.journal.update(handle.name, atime = handle.times[0], mtime = handle.times[1])
+        handle.close()
+        self.trim()
+
+    def trim(self):
+        ''' Forget the least recently used idle files beyond the limit.
+        '''
+        with self.lock:
+            while len(self.idle) > self.max_idle_files:
+                name, handle = self.idle.popitem(last = False)
+                if self.files.get(name) is handle and self.open_files.count(handle) == 0 and handle.opens == 0:
+                    self.files.pop(name)
 
     def get_handle_from_path(self, path):
-        if path in self.files:
-            return self.files[path]
-        else:
-            raise Exception("File %s does not exist" % (path))
+        with self.lock:
+            if path in self.files:
+                return self.files[path]
+        raise Exception("File %s does not exist" % (path))
 
     def get_handle(self, fh):
-        if fh in self.handles:
-            return self.handles[fh]
-        else:
-            raise Exception("File handle %d does not exist" % (fh))
+        with self.lock:
+            entry = self.open_files.get(fh)
+            if entry is not None:
+                return entry.handle
+        raise Exception("File handle %d does not exist" % (fh))
+
+    def loaded_handle(self, name):
+        ''' Return the handle for `name` if it is currently open, else None.
+        '''
+        with self.lock:
+            handle = self.files.get(name)
+        if handle is not None and handle.is_loaded:
+            return handle
+        return None
 
     def create_local_file(self, name, mode):
         fullpath = self._full_path(name)
-        print "creating a local file %d" % (self.descriptor_seq)
-        if not self.contains_file(name):
-            self.files[name] = LocalFileHandle(name, fullpath, mode, self.descriptor_seq)
-            self.handles[self.descriptor_seq] = self.files[name]
-            self.descriptor_seq += 1
-        return self.files[name]
+        with self.lock:
+            if name not in self.files:
+                if self.chunk_store is not None:
+                    self.files[name] = DedupFileHandle(name, fullpath, mode, self.inode_seq, self.page_cache, self.chunk_store)
+                elif self.keys is None and self.use_mmap:
+                    self.files[name] = MappedFileHandle(name, fullpath, mode, self.inode_seq, self.page_cache)
+                elif self.keys is None:
+                    self.files[name] = LocalFileHandle(name, fullpath, mode, self.inode_seq, self.page_cache)
+                else:
+                    self.files[name] = EncryptedFileHandle(name, fullpath, mode, self.inode_seq, self.page_cache, self.keys, self.crypto_pool, self.codec)
+                self.files[name].prefetcher = self.prefetcher
+                self.files[name].metrics = self.metrics
+                self.files[name].wal = self.wal
+                self.inode_seq += 1
+                self.idle[name] = self.files[name]
+            handle = self.files[name]
+        self.trim()
+        return handle
+
+    def truncate(self, name, length, fid = None):
+        ''' Set the length of `name`, through descriptor `fid` if given
+        (ftruncate) or by opening it for the duration otherwise.
+        '''
+        if fid is not None:
+            return self.get_handle(fid).truncate(length)
+        fid = self.open(name, os.O_RDWR)
+        try:
+            self.get_handle(fid).truncate(length)
+        finally:
+            self.release(fid)
+
+    def file_size(self, name, backing_size):
+        ''' Return the plaintext size of a file whose backing file holds
+        `backing_size` bytes.
+        '''
+        if self.keys is None and self.chunk_store is None:
+            return backing_size
+        handle = self.loaded_handle(name)
+        if handle is not None:
+            return handle.size
+        if self.chunk_store is not None:
+            manifest = read_manifest(self._full_path(name))
+            return manifest["size"] if manifest is not None else backing_size
+        if backing_size <= HEADER.size:
+            return 0
+        with open(self._full_path(name), "rb") as fh:
+            header = fh.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return 0
+            chunk_size, salt = parse_header(header)
+            last = (backing_size - HEADER.size - 1) // (chunk_size + CHUNK_OVERHEAD)
+            fh.seek(chunk_offset(last, chunk_size))
+            return plaintext_size(backing_size, fh.read(CHUNK_HEADER.size), chunk_size)
+
+    def flush(self, fid):
+        ''' Persist a handle's dirty data; in write-back mode this only
+        queues it for the background flusher.
+        '''
+        handle = self.get_handle(fid)
+        if self.flusher is None:
+            handle.fsync()
+        else:
+            self.flusher.flush(handle)
 
     def fsync(self, fid):
-        print "fsync in the ContentStore: %s " % (str(fid))
-        for handle in self.handles:
-            print str(handle)
-        handle = self.handles[fid]
-        handle.fsync()
-
-    def get_files_in_namespace(files, prefix):
-        fileset = []
-        for fhandle in self.files:
-            if fhandle.name.startswith(prefix):
-                fileset.append(fhandle.name)
-        return fileset
+        ''' Persist a handle's dirty data and return once it is durable.
+        '''
+        handle = self.get_handle(fid)
+        if self.flusher is None:
+            handle.fsync()
+        else:
+            self.flusher.sync(handle)
+        self.journal.sync()
+
+    def discard(self, name):
+        ''' Called before the backing file of `name` is unlinked, so the
+        chunks only it refers to can be freed.
+        '''
+        if self.chunk_store is None:
+            return
+        handle = self.loaded_handle(name)
+        if handle is not None:
+            handle.discard()
+            return
+        fullpath = self._full_path(name)
+        if os.path.isfile(fullpath) and os.lstat(fullpath).st_nlink == 1:
+            manifest = read_manifest(fullpath)
+            if manifest is not None:
+                self.chunk_store.release(manifest["chunks"])
+
+    def close(self):
+        ''' Write back everything still pending and stop background workers.
+        '''
+        if self.flusher is not None:
+            self.flusher.stop()
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.crypto_pool is not None:
+            self.crypto_pool.close()
+        if self.wal is not None:
+            self.wal.stop()
+        self.journal.stop()
+
+    def get_files_in_namespace(self, prefix):
+        with self.lock:
+            return [name for name, fhandle in self.files.items(prefix)]
 
     def read_namespace(self, prefix):
-        return get_files_in_namespace(self.files, prefix)
+        ''' Return the names immediately below `prefix`.
+        '''
+        with self.lock:
+            return self.files.children(prefix)
 
     def delete_namespace(self, prefix):
-        fileset = get_files_in_namespace(self.files, prefix)
-        for fhandle in fileset:
+        with self.lock:
+            fileset = self.files.pop_prefix(prefix)
+            for name, fhandle in fileset:
+                self.idle.pop(name, None)
+        for name, fhandle in fileset:
             fhandle.unload()
-            self.files.pop(fhandle.name, None)
 
     def access(self, name):
         if not self.contains_file(name):
-            print "need to fetch it... and if not here, raise Exception"
+            TRACER.info("%s is not stored locally", name)
+
+    def attributes(self, name, attrs):
+        ''' Overlay the journaled attributes of `name` on the stat dict
+        `attrs`, in place.
+        '''
+        journaled = self.journal.get(name)
+        if journaled is None:
+            return attrs
+        if "mode" in journaled:
+            attrs['st_mode'] = (attrs['st_mode'] & ~07777) | (journaled["mode"] & 07777)
+        if "uid" in journaled:
+            attrs['st_uid'] = journaled["uid"]
+        if "gid" in journaled:
+            attrs['st_gid'] = journaled["gid"]
+        if "mtime" in journaled:
+            attrs['st_atime'], attrs['st_mtime'] = journaled["atime"], journaled["mtime"]
+        return attrs
 
     def chmod(self, name, mode):
-        self.files[name].mode = mode
+        self.journal.update(name, mode = mode)
+        with self.lock:
+            handle = self.files.get(name)
+        if handle is not None:
+            handle.mode = mode
         return mode
 
     def chown(self, name, uid, gid):
-        self.files[name].uid = uid
-        self.files[name].uid = gid
+        ''' Record a new owner; -1 leaves the uid or gid unchanged.
+        '''
+        attrs = {}
+        if uid != -1:
+            attrs["uid"] = uid
+        if gid != -1:
+            attrs["gid"] = gid
+        self.journal.update(name, **attrs)
+        with self.lock:
+            handle = self.files.get(name)
+        if handle is not None:
+            handle.uid = attrs.get("uid", handle.uid)
+            handle.gid = attrs.get("gid", handle.gid)
         return True
 
-    def symlink(self, name, target):
-        if name not in self.files:
-            raise Exception("%s not a valid file" % (name))
-        if target in self.files:
+    def rename(self, old, new):
+        ''' Move `old`, and everything below it, to `new`. Known handles
+        follow the rename, and so do the journaled attributes.
+        '''
+        if old == new:
             return
-        self.files[target] = self.files[name]
+        with self.lock:
+            for name, handle in self.files.pop_prefix(new):
+                self.idle.pop(name, None)
+                handle.wal = None
+            for name, handle in self.files.pop_prefix(old):
+                renamed = new + name[len(old):]
+                idle = self.idle.pop(name, None) is not None
+                handle.name = renamed
+                handle.fullpath = self._full_path(renamed)
+                self.files[renamed] = handle
+                if idle:
+                    self.idle[renamed] = handle
+        self.journal.rename(old, new)
+        if self.wal is not None:
+            self.wal.rename(old, new)
+
+    def forget(self, name):
+        ''' Drop the journaled attributes, logged writes and cached key of a
+        name that no longer exists.
+        '''
+        self.journal.remove(name)
+        if self.keys is not None:
+            self.keys.forget(name)
+        if self.wal is not None:
+            self.wal.unlink(name)
+
+    def symlink(self, name, target):
+        with self.lock:
+            if name not in self.files:
+                raise Exception("%s not a valid file" % (name))
+            if target in self.files:
+                return
+            self.files[target] = self.files[name]
 
     def unlink(self, name):
-        if name not in self.files:
-            raise Exception("%s not a valid file" % (name))
-        self.files[name].close()
-        del self.files[name]
+        ''' Forget the name `name`. Descriptors already open on it keep
+        working until they are released.
+        '''
+        with self.lock:
+            if name not in self.files:
+                raise Exception("%s not a valid file" % (name))
+            # Writes to an unlinked file need no redo.
+            self.files.pop(name).wal = None
+            self.idle.pop(name, None)
 
     def utime(self, name, times):
-        if name not in self.files:
-            raise Exception("%s not a valid file" % (name))
-        self.files[name].times = times
+        times = tuple(times or (time.time(), time.time()))
+        self.journal.update(name, atime = times[0], mtime = times[1])
+        with self.lock:
+            handle = self.files.get(name)
+        if handle is not None:
+            handle.times = times
@@ -1,7 +1,13 @@
-mport sys
+import sys
 import os
 import getopt
 import base64
+import struct
+import threading
+import itertools
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import crc16
 import binascii
@@ -14,6 +20,39 @@ from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, hmac
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from Compressor import *
+
+backend = default_backend()
+
+# Encrypted files are a small header followed by fixed-stride chunk slots:
+#
+#   header: magic, version, plaintext chunk size, salt
+#   slot i: flags, nonce suffix, plaintext length, ciphertext, tag
+#
+# Slot i always starts at chunk_offset(i), so any chunk can be read, opened
+# and resealed on its own. Each chunk's 96-bit GCM nonce is its index
+# followed by a random suffix chosen every time it is sealed, and the file
+# salt plus the chunk header are authenticated as additional data.
+#
+# The low bits of the flags name the codec a chunk was compressed with
+# before sealing. A compressed chunk stores the length of its compressed
+# payload right after the header (authenticated too), and still records
+# the plaintext length in the header, so sizes never need decryption.
+# The rest of a slot is unused; it is punched out of the backing file
+# whenever a shorter record is written, so compressed chunks take up only
+# the disk blocks they need.
+MAGIC = "ENFS"
+VERSION = 1
+CHUNK_SIZE = 64 * 1024
+SALT_SIZE = 16
+TAG_SIZE = 16
+HEADER = struct.Struct(">4sBI%ds" % (SALT_SIZE))
+CHUNK_HEADER = struct.Struct(">B8sI")
+CHUNK_OVERHEAD = CHUNK_HEADER.size + TAG_SIZE
+STORED_LENGTH = struct.Struct(">I")
+KEY_CACHE_SIZE = 1024
 
 class KDF(object):
     def __init__(self):
@@ -21,42 +60,169 @@ class KDF(object):
 
     def derive(self, password, salt, c = 100000, length = 32):
         global backend
-        self.kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=length, salt=salt, iterations=c, backend=bckend)
-        return kdf.derive(password)
+        self.kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=length, salt=salt, iterations=c, backend=backend)
+        return self.kdf.derive(password)
+
+def derive_file_key(master_key, salt, length = 32):
+    ''' Derive a file's key from the mount's master key and the file's salt.
+    The name is deliberately not an input, so renames keep their key.
+    '''
+    global backend
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=length, salt=salt, info="enfs file key", backend=backend)
+    return hkdf.derive(master_key)
+
+class KeyCache(object):
+    ''' Bounded LRU of per-file keys, keyed by path. The expensive PBKDF2
+    step runs once, when the master key is derived from the passphrase;
+    a miss here only costs one HKDF.
+    '''
+    def __init__(self, master_key, capacity = KEY_CACHE_SIZE):
+        self.master_key = master_key
+        self.capacity = capacity
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def file_key(self, name, salt):
+        with self.lock:
+            entry = self.keys.pop(name, None)
+            if entry is None or entry[0] != salt:
+                entry = (salt, derive_file_key(self.master_key, salt))
+            self.keys[name] = entry
+            while len(self.keys) > self.capacity:
+                self.keys.popitem(last = False)
+            return entry[1]
+
+    def forget(self, name):
+        with self.lock:
+            self.keys.pop(name, None)
+
+class CryptoPool(object):
+    ''' Worker threads that seal and open independent chunks in parallel.
+    The AES backend releases the GIL, so this scales with cores; results
+    always come back in input order.
+    '''
+    def __init__(self, workers = None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = ThreadPool(self.workers) if self.workers > 1 else None
+
+    def imap(self, func, items):
+        if self.pool is None or len(items) < 2:
+            return itertools.imap(func, items)
+        return self.pool.imap(func, items, max(1, len(items) // (self.workers * 4)))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
 class CipherAESGCM(object):
     def __init__(self, key = "", iv = ""):
         self.key = key
         self.iv = iv
 
-    def seal(self, blob):
+    def seal(self, blob, aad = ""):
         global backend
         cipher = Cipher(algorithms.AES(self.key), modes.GCM(self.iv), backend=backend)
         encryptor = cipher.encryptor()
+        if aad:
+            encryptor.authenticate_additional_data(aad)
         ct = encryptor.update(blob) + encryptor.finalize()
-        return base64.b64encode("".join([self.iv, ct, encryptor.tag]))
-    
-    def open(self, blob):
-        pass
+        return ct + encryptor.tag
+
+    def open(self, blob, aad = ""):
+        global backend
+        ct, tag = blob[:-TAG_SIZE], blob[-TAG_SIZE:]
+        cipher = Cipher(algorithms.AES(self.key), modes.GCM(self.iv, tag), backend=backend)
+        decryptor = cipher.decryptor()
+        if aad:
+            decryptor.authenticate_additional_data(aad)
+        return decryptor.update(ct) + decryptor.finalize()
+
+def file_header(salt, chunk_size = CHUNK_SIZE):
+    return HEADER.pack(MAGIC, VERSION, chunk_size, salt)
 
-def encrypt(fname, blob):
-    salt = os.urandom(32)
-    iv = os.urandom(16)
+def parse_header(blob):
+    ''' Return the (chunk size, salt) recorded in an encrypted file header.
+    '''
+    if len(blob) < HEADER.size:
+        raise Exception("Truncated ENFS header")
+    magic, version, chunk_size, salt = HEADER.unpack(blob[:HEADER.size])
+    if magic != MAGIC or version != VERSION:
+        raise Exception("Not an ENFS v%d file" % (VERSION))
+    return chunk_size, salt
 
-    key = KDF().derive(fname, salt)
-    cipher = CipherAESGCM(key, iv)
+def chunk_offset(index, chunk_size = CHUNK_SIZE):
+    return HEADER.size + index * (chunk_size + CHUNK_OVERHEAD)
 
-    ciphertext = cipher.seal(blob)
-    
-    data = [base64.b64encode(salt), base64.b64encode(iv), ciphertext]
+def chunk_length(record):
+    ''' Plaintext length of a sealed chunk, from its header alone; an empty
+    or all-zero slot (a hole) has length zero.
+    '''
+    if len(record) < CHUNK_HEADER.size:
+        return 0
+    return CHUNK_HEADER.unpack(record[:CHUNK_HEADER.size])[2]
 
-    print data
-    print len(data[0]), len(data[1]), len(data[2])
+def plaintext_size(backing_size, last_record, chunk_size = CHUNK_SIZE):
+    ''' Plaintext size of an encrypted file, given the size of the backing
+    file and the header of its last chunk slot.
+    '''
+    if backing_size <= HEADER.size:
+        return 0
+    last = (backing_size - HEADER.size - 1) // (chunk_size + CHUNK_OVERHEAD)
+    return last * chunk_size + chunk_length(last_record)
 
-    return "".join(data)
+def seal_chunk(key, salt, index, plaintext, codec = NONE):
+    codec, payload = compress_chunk(codec, plaintext, STORED_LENGTH.size)
+    suffix = os.urandom(8)
+    header = CHUNK_HEADER.pack(codec, suffix, len(plaintext))
+    if codec != NONE:
+        header += STORED_LENGTH.pack(len(payload))
+    cipher = CipherAESGCM(key, struct.pack(">I", index) + suffix)
+    return header + cipher.seal(payload, salt + header)
 
-def decrypt(fname, blob):
-    # TODO: parse the blob to extract the salt and IV, and then perform the decryption
-    pass
+def open_chunk(key, salt, index, record):
+    ''' Authenticate, decrypt and decompress one chunk slot. A hole opens
+    to "".
+    '''
+    if len(record) < CHUNK_OVERHEAD or record[:CHUNK_HEADER.size] == "\0" * CHUNK_HEADER.size:
+        return ""
+    header = record[:CHUNK_HEADER.size]
+    flags, suffix, length = CHUNK_HEADER.unpack(header)
+    codec = flags & CODEC_MASK
+    stored = length
+    if codec != NONE:
+        header = record[:CHUNK_HEADER.size + STORED_LENGTH.size]
+        stored = STORED_LENGTH.unpack(header[CHUNK_HEADER.size:])[0]
+    body = record[len(header):len(header) + stored + TAG_SIZE]
+    cipher = CipherAESGCM(key, struct.pack(">I", index) + suffix)
+    payload = cipher.open(body, salt + header)
+    if codec != NONE:
+        return decompress(codec, payload, length)
+    return payload
 
+def encrypt(password, blob, chunk_size = CHUNK_SIZE, codec = NONE):
+    ''' Encrypt a whole blob into the chunked file format, compressing
+    each chunk with `codec` where that pays off.
+    '''
+    salt = os.urandom(SALT_SIZE)
+    key = KDF().derive(password, salt)
+    records = []
+    for index, offset in enumerate(range(0, len(blob), chunk_size)):
+        records.append(seal_chunk(key, salt, index, blob[offset:offset + chunk_size], codec))
+    # Every slot but the last is padded out to the full stride.
+    return file_header(salt, chunk_size) + "".join(
+        record.ljust(chunk_size + CHUNK_OVERHEAD, "\0") for record in records[:-1]) + "".join(records[-1:])
 
+def decrypt(password, blob):
+    ''' Decrypt a blob produced by encrypt().
+    '''
+    chunk_size, salt = parse_header(blob)
+    key = KDF().derive(password, salt)
+    slot = chunk_size + CHUNK_OVERHEAD
+    chunks = []
+    for index, offset in enumerate(range(HEADER.size, len(blob), slot)):
+        chunks.append(open_chunk(key, salt, index, blob[offset:offset + slot]).ljust(chunk_size, "\0"))
+    if not chunks:
+        return ""
+    return "".join(chunks)[:plaintext_size(len(blob), blob[offset:], chunk_size)]
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import sys
+import bisect
+
+class ExtentMap(object):
+    ''' A set of disjoint, half-open byte ranges [start, end), kept sorted.
+    Overlapping or touching ranges are coalesced as they are added.
+    '''
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def total(self):
+        return sum(end - start for start, end in self)
+
+    def clear(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        first = bisect.bisect_left(self.ends, start)
+        last = bisect.bisect_right(self.starts, end)
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+
+    def remove(self, start, end = sys.maxsize):
+        if start >= end:
+            return
+        first = bisect.bisect_right(self.ends, start)
+        last = bisect.bisect_left(self.starts, end)
+        if first >= last:
+            return
+        starts = []
+        ends = []
+        if self.starts[first] < start:
+            starts.append(self.starts[first])
+            ends.append(start)
+        if self.ends[last - 1] > end:
+            starts.append(end)
+            ends.append(self.ends[last - 1])
+        self.starts[first:last] = starts
+        self.ends[first:last] = ends
+
+    def covers(self, start, end):
+        ''' Return whether [start, end) lies entirely inside one extent.
+        '''
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def ranges(self, start = 0, end = sys.maxsize):
+        ''' Return the extents overlapping [start, end), clipped to it.
+        '''
+        first = bisect.bisect_right(self.ends, start)
+        last = bisect.bisect_left(self.starts, end)
+        return [(max(s, start), min(e, end)) for s, e in zip(self.starts[first:last], self.ends[first:last])]
@@ -3,14 +3,47 @@
 # -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
 
 import os
+import mmap
+import time
 import hashlib
+import threading
+import itertools
+
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (ImportError, OSError, AttributeError):
+    fallocate = None
+
+from Encrypter import *
+from ChunkStore import *
+from ReadAhead import *
+from common.Metrics import *
+from Extents import *
+from common.Locks import *
+from common.Trace import *
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+def punch_hole(fd, offset, length):
+    ''' Free the disk blocks under a byte range of `fd`, which then reads
+    as zeros. Returns False where the platform or file system cannot.
+    '''
+    if fallocate is None or length <= 0:
+        return False
+    return fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
 
 class FileHandle(object):
-    def __init__(self, name, fullpath, mode, fid):
+    def __init__(self, name, fullpath, mode, ino, cache):
         self.fullpath = fullpath
         self.name = name
         self.mode = mode
-        self.fid = fid
+        self.ino = ino
+        self.cache = cache
         self.offset = 0
         self.size = 0
         self.access = False
@@ -19,80 +52,568 @@ class FileHandle(object):
         self.times = (0, 0)
         self.flags = os.O_RDONLY # default
         self.is_loaded = False
+        self.opens = 0
+        self.dirty = ExtentMap()
+        # Ranges known to read as zeros (e.g. grown by truncate) that have
+        # not been written since; they are never read from the backing store.
+        self.holes = ExtentMap()
+        self.lock = RWLock()
+        self.readahead = ReadAhead()
+        self.prefetcher = None
+        self.metrics = NULL_METRICS
+        # The store's WriteAheadLog, if it keeps one.
+        self.wal = None
 
     def load(self):
-        print "WTF..."
         pass
 
     def unload(self):
-        print "%s unloaded" % (self.fullpath)
-        self.data = None
-        self.size = 0
-        self.is_loaded = False
+        TRACER.debug("unload %s", self.fullpath)
+        with self.lock.writing():
+            self.writeback()
+            self.cache.drop(self)
+            self.holes.clear()
+            self.size = 0
+            self.is_loaded = False
 
-    def read(self, offset, length):
-        print "READ %s %d %d %d %s" % (self.fullpath, offset, length, self.size, str(self.data))
-        max_offset = max(self.size, offset + length)
-        if offset > self.size:
-            return None
+    def load_page(self, index):
+        ''' Fetch the contents of page `index` from the backing store.
+        '''
+        return ""
+
+    def store_range(self, offset, data):
+        ''' Write `data` to the backing store at byte `offset`.
+        '''
+        pass
+
+    def resize(self, length):
+        ''' Set the length of the backing store.
+        '''
+        pass
+
+    def sync(self):
+        ''' Make everything written to the backing store durable.
+        '''
+        pass
+
+    def page(self, index):
+        ''' Return page `index`, faulting it into the cache if necessary.
+        '''
+        page = self.cache.lookup(self, index)
+        if page is not None:
+            self.metrics.count("page_cache.hits")
         else:
-            return self.data[offset:max_offset]
+            self.metrics.count("page_cache.misses")
+            if self.page_in_hole(index):
+                page = bytearray(min(self.cache.page_size, self.size - index * self.cache.page_size))
+            else:
+                page = bytearray(self.load_page(index))
+            self.cache.insert(self, index, page)
+        return page
+
+    def page_in_hole(self, index):
+        base = index * self.cache.page_size
+        end = min(base + self.cache.page_size, self.size)
+        return end > base and self.holes.covers(base, end)
+
+    def fault_pages(self, indices):
+        ''' Bring every page in `indices` into the cache.
+        '''
+        for index in indices:
+            if not self.page_in_hole(index):
+                self.page(index)
+
+    def dirty_pages(self):
+        ''' Return the sorted indices of pages holding dirty bytes.
+        '''
+        page_size = self.cache.page_size
+        indices = []
+        for start, end in self.dirty:
+            first = max(start // page_size, indices[-1] + 1 if indices else 0)
+            indices.extend(range(first, (end - 1) // page_size + 1))
+        return indices
+
+    def flush_page(self, index, page):
+        ''' Write the dirty ranges inside page `index` back to the backing
+        store.
+        '''
+        base = index * self.cache.page_size
+        for start, stop in self.dirty.ranges(base, base + self.cache.page_size):
+            self.store_range(start, page[start - base:stop - base])
+
+    def evict_page(self, index, page):
+        ''' Called by the page cache when it drops one of our pages.
+        '''
+        self.flush_page(index, page)
+        base = index * self.cache.page_size
+        self.dirty.remove(base, base + self.cache.page_size)
+
+    def writeback(self):
+        ''' Write every dirty page back to the backing store.
+        '''
+        for index in self.dirty_pages():
+            self.flush_page(index, self.cache.lookup(self, index))
+        self.dirty.clear()
+
+    def read(self, offset, length):
+        with self.lock.reading():
+            data = self.read_pages(offset, length)
+            ahead = self.readahead.observe(offset, length, self.cache.page_size, self.size)
+        if self.prefetcher is not None:
+            # Never read ahead more than a quarter of the cache.
+            self.prefetcher.submit(self, ahead[:self.cache.budget // (4 * self.cache.page_size)])
+        return data
+
+    def read_pages(self, offset, length):
+        page_size = self.cache.page_size
+        end = min(self.size, offset + length)
+        chunks = []
+        while offset < end:
+            index = offset // page_size
+            base = index * page_size
+            stop = min(page_size, end - base)
+            if self.holes.covers(offset, base + stop):
+                chunks.append("\0" * (base + stop - offset))
+                offset = base + stop
+                continue
+            piece = str(self.page(index)[offset - base:stop])
+            chunks.append(piece)
+            if len(piece) < stop - (offset - base):
+                # Bytes past the end of a short page are a hole.
+                chunks.append("\0" * (stop - (offset - base) - len(piece)))
+            offset = base + stop
+        return "".join(chunks)
 
     def write(self, buff, offset):
+        with self.lock.writing():
+            return self.write_pages(buff, offset)
+
+    def write_pages(self, buff, offset):
+        page_size = self.cache.page_size
+        pos = 0
+        while pos < len(buff):
+            index = (offset + pos) // page_size
+            start = offset + pos - index * page_size
+            count = min(page_size - start, len(buff) - pos)
+            if start == 0 and count == page_size:
+                page = bytearray(page_size)
+                self.cache.insert(self, index, page)
+            else:
+                page = self.page(index)
+                if len(page) < start:
+                    page.extend("\0" * (start - len(page)))
+            page[start:start + count] = buff[pos:pos + count]
+            self.dirty.add(offset + pos, offset + pos + count)
+            self.holes.remove(offset + pos, offset + pos + count)
+            pos += count
         length = len(buff) + offset
         if length > self.size:
             self.size = length
-        self.data = buff
+        self.times = (self.times[0], time.time())
         return len(buff)
 
     def truncate(self, length):
-        ''' Truncate the file to specified length.
+        ''' Truncate the file to specified length. Growing it only records
+        a hole; shrinking it drops the cached pages past the end.
         '''
-        self.size = length
-        self.data = self.data[:length]
+        page_size = self.cache.page_size
+        first = (length + page_size - 1) // page_size
+        with self.lock.writing():
+            if length > self.size:
+                self.holes.add(self.size, length)
+            else:
+                self.holes.remove(length)
+            self.cache.drop(self, first)
+            self.dirty.remove(length)
+            if length % page_size:
+                page = self.cache.lookup(self, length // page_size)
+                if page is not None:
+                    del page[length % page_size:]
+            self.size = length
+            self.times = (self.times[0], time.time())
+            self.resize(length)
 
     def fsync(self):
         ''' Force a write to the file system.
         '''
-        print "FSYNC called to %s" % (self.fullpath)
-        if self.data != None:
-            with open(self.fullpath, "w") as fh:
-                hasher = hashlib.new("sha256")
-                hasher.update(self.data)
-                digest = hasher.hexdigest()
-                fh.write(digest)
-                self.data = digest
-                self.size = len(digest)
-
-                # fh.write(self.data)
+        TRACER.debug("fsync %s", self.fullpath)
+        with self.lock.writing():
+            self.writeback()
+            self.sync()
 
     def close(self):
-        ''' Unload and release all resources.
+        ''' Drop one open reference; the last one unloads and releases all
+        resources.
         '''
-        self.unload()
-        print "STill loaded? %d" % (self.is_loaded)
+        with self.lock.writing():
+            self.opens = max(self.opens - 1, 0)
+            if self.opens == 0:
+                self.unload()
 
 class LocalFileHandle(FileHandle):
-    def __init__(self, name, fullpath, mode, fid):
-        super(LocalFileHandle, self).__init__(name, fullpath, mode, fid)
-        result = os.open(fullpath, os.O_RDWR | os.O_CREAT, mode)
-        print "OS open result %d" % (result)
-        self.load()
+    def __init__(self, name, fullpath, mode, ino, cache):
+        super(LocalFileHandle, self).__init__(name, fullpath, mode, ino, cache)
+        self.fd = None
+        # Serializes seek+read/write pairs on the shared descriptor.
+        self.io_lock = threading.Lock()
 
     def load(self):
-        print "trying to load... %d" % (self.is_loaded)
-        if not self.is_loaded:
-            print "LOCAL LOAD %s" % (self.fullpath)
-            # TODO: we'd do the decryption here
-            with open(self.fullpath) as fhandle:
-                self.data = fhandle.read()
-                self.size = len(self.data)
-            self.is_loaded = True
-            print "lOADED!"
+        with self.lock.writing():
+            self.opens += 1
+            if not self.is_loaded:
+                TRACER.debug("load %s", self.fullpath)
+                self.fd = os.open(self.fullpath, os.O_RDWR | os.O_CREAT, self.mode)
+                st = os.fstat(self.fd)
+                self.size = st.st_size
+                self.times = (st.st_atime, st.st_mtime)
+                self.is_loaded = True
         return self
 
+    def unload(self):
+        with self.lock.writing():
+            super(LocalFileHandle, self).unload()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def load_page(self, index):
+        page_size = self.cache.page_size
+        with self.io_lock:
+            os.lseek(self.fd, index * page_size, os.SEEK_SET)
+            return os.read(self.fd, page_size)
+
+    def store_range(self, offset, data):
+        with self.io_lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            os.write(self.fd, data)
+        if self.wal is not None:
+            self.wal.write(self.name, self.fd, offset, data)
+
+    def truncate_backing(self, length):
+        with self.io_lock:
+            os.ftruncate(self.fd, length)
+        if self.wal is not None:
+            self.wal.truncate(self.name, self.fd, length)
+
+    def resize(self, length):
+        self.truncate_backing(length)
+
+    def sync(self):
+        if self.wal is not None:
+            self.wal.sync()
+        elif self.fd is not None:
+            os.fsync(self.fd)
+
     def __str__(self):
-        return self.fullpath + "-" + str(self.fid)
+        return self.fullpath + "-" + str(self.ino)
+
+class MappedFileHandle(LocalFileHandle):
+    ''' A local file served straight from an mmap of its backing file,
+    bypassing the page cache. read() copies straight out of the mapping
+    while holding the read lock: a buffer handed out instead could be
+    touched after a truncate shrank the file below it, which is SIGBUS.
+    '''
+    def __init__(self, name, fullpath, mode, ino, cache):
+        super(MappedFileHandle, self).__init__(name, fullpath, mode, ino, cache)
+        self.map = None
+
+    def load(self):
+        with self.lock.writing():
+            super(MappedFileHandle, self).load()
+            if self.map is None:
+                self.remap()
+        return self
+
+    def remap(self):
+        ''' Map the whole backing file. Called with the write lock held, so
+        no read is copying from the mapping it replaces.
+        '''
+        self.map = mmap.mmap(self.fd, self.size) if self.size else None
+
+    def unload(self):
+        with self.lock.writing():
+            if self.map is not None:
+                self.map.flush()
+                self.map = None
+            super(MappedFileHandle, self).unload()
+
+    def read(self, offset, length):
+        with self.lock.reading():
+            end = min(self.size, offset + length)
+            if offset >= end:
+                return ""
+            return self.map[offset:end]
+
+    def write(self, buff, offset):
+        with self.lock.writing():
+            end = offset + len(buff)
+            if end > self.size:
+                self.resize(end)
+                self.size = end
+                self.remap()
+            if buff:
+                self.map[offset:end] = buff
+            self.times = (self.times[0], time.time())
+            return len(buff)
+
+    def truncate(self, length):
+        with self.lock.writing():
+            self.map = None
+            self.resize(length)
+            self.size = length
+            self.times = (self.times[0], time.time())
+            self.remap()
+
+    def sync(self):
+        if self.map is not None:
+            self.map.flush()
+        super(MappedFileHandle, self).sync()
+
+class EncryptedFileHandle(LocalFileHandle):
+    ''' A local file stored in the chunked AES-GCM format from Encrypter.
+
+    Each cache page is exactly one chunk, so faulting a page in opens a
+    single chunk and writing a dirty page back reseals only that chunk.
+    With a `codec`, pages are compressed before they are sealed.
+    '''
+    def __init__(self, name, fullpath, mode, ino, cache, keys, pool, codec = NONE):
+        super(EncryptedFileHandle, self).__init__(name, fullpath, mode, ino, cache)
+        self.keys = keys
+        self.pool = pool
+        self.codec = codec
+        self.key = None
+        self.salt = None
+
+    def load(self):
+        with self.lock.writing():
+            loaded = self.is_loaded
+            super(EncryptedFileHandle, self).load()
+            if not loaded:
+                chunk_size = self.cache.page_size
+                with self.io_lock:
+                    os.lseek(self.fd, 0, os.SEEK_SET)
+                    header = os.read(self.fd, HEADER.size)
+                if header:
+                    chunk_size, self.salt = parse_header(header)
+                else:
+                    self.salt = os.urandom(SALT_SIZE)
+                    self.store_range(0, file_header(self.salt, chunk_size))
+                if chunk_size != self.cache.page_size:
+                    raise Exception("%s uses %d byte chunks, not %d" % (self.fullpath, chunk_size, self.cache.page_size))
+                backing_size = os.fstat(self.fd).st_size
+                self.size = 0
+                if backing_size > HEADER.size:
+                    last = (backing_size - HEADER.size - 1) // (chunk_size + CHUNK_OVERHEAD)
+                    self.size = plaintext_size(backing_size, self.read_record(last), chunk_size)
+                self.key = self.keys.file_key(self.name, self.salt)
+        return self
+
+    def read_record(self, index):
+        slot = self.cache.page_size + CHUNK_OVERHEAD
+        with self.io_lock:
+            os.lseek(self.fd, chunk_offset(index, self.cache.page_size), os.SEEK_SET)
+            return os.read(self.fd, slot)
+
+    def load_page(self, index):
+        record = self.read_record(index)
+        with self.metrics.timing("crypto.open"):
+            return open_chunk(self.key, self.salt, index, record)
+
+    def read_pages(self, offset, length):
+        # Open every chunk the request misses in the cache on the crypto
+        # pool first; the base class then serves the read from the cache.
+        page_size = self.cache.page_size
+        end = min(self.size, offset + length)
+        if end > offset:
+            self.fault_pages([index for index in range(offset // page_size, (end - 1) // page_size + 1)
+                              if self.cache.lookup(self, index) is None and not self.page_in_hole(index)])
+        return super(EncryptedFileHandle, self).read_pages(offset, length)
+
+    def fault_pages(self, indices):
+        indices = [index for index in indices if not self.page_in_hole(index)]
+        if len(indices) < 2:
+            return super(EncryptedFileHandle, self).fault_pages(indices)
+        records = [(index, self.read_record(index)) for index in indices]
+        with self.metrics.timing("crypto.open"):
+            opened = list(self.pool.imap(lambda (index, record): open_chunk(self.key, self.salt, index, record), records))
+        for index, plaintext in itertools.izip(indices, opened):
+            self.cache.insert(self, index, bytearray(plaintext))
+
+    def writeback(self):
+        indices = self.dirty_pages()
+        pages = [(index, str(self.cache.lookup(self, index))) for index in indices]
+        with self.metrics.timing("crypto.seal"):
+            sealed = list(self.pool.imap(lambda (index, page): seal_chunk(self.key, self.salt, index, page, self.codec), pages))
+        for index, record in itertools.izip(indices, sealed):
+            self.store_record(index, record)
+        self.dirty.clear()
+
+    def flush_page(self, index, page):
+        if self.dirty.ranges(index * self.cache.page_size, (index + 1) * self.cache.page_size):
+            with self.metrics.timing("crypto.seal"):
+                record = seal_chunk(self.key, self.salt, index, str(page), self.codec)
+            self.store_record(index, record)
+
+    def store_record(self, index, record):
+        offset = chunk_offset(index, self.cache.page_size)
+        self.store_range(offset, record)
+        # A longer record may have filled this slot before, so free the
+        # rest of it; the last slot ends the file and has no rest.
+        slot = self.cache.page_size + CHUNK_OVERHEAD
+        if len(record) < slot and (index + 1) * self.cache.page_size < self.size:
+            punch_hole(self.fd, offset + len(record), slot - len(record))
+
+    def resize(self, length):
+        page_size = self.cache.page_size
+        if length == 0:
+            self.truncate_backing(HEADER.size)
+            return
+        # The new last chunk records the file length, so reseal it padded
+        # (or cut) to exactly the bytes that remain, and drop later slots.
+        index = (length - 1) // page_size
+        page = self.page(index)
+        end = length - index * page_size
+        if len(page) < end:
+            page.extend("\0" * (end - len(page)))
+        del page[end:]
+        self.dirty.add(index * page_size, length)
+        self.truncate_backing(chunk_offset(index + 1, page_size))
+
+class DedupFileHandle(FileHandle):
+    ''' A local file stored as a manifest of content-addressed chunks.
+
+    Each cache page is one chunk. Writing a dirty page back stores its chunk
+    in the ChunkStore (a no-op if an identical chunk is already there) and
+    points the manifest at it; the manifest itself is rewritten on sync.
+    '''
+    def __init__(self, name, fullpath, mode, ino, cache, chunks):
+        super(DedupFileHandle, self).__init__(name, fullpath, mode, ino, cache)
+        self.store = chunks
+        self.chunks = [] # digest of each chunk, None for a hole
+        self.persisted = [] # the chunk list of the manifest on disk
+        self.persisted_size = 0 # and the size it records
+        self.pinned = [] # chunks put since the manifest was last written
+        self.manifest_dirty = False
+        self.unlinked = False
+
+    def load(self):
+        with self.lock.writing():
+            self.opens += 1
+            if not self.is_loaded:
+                self.chunks = []
+                self.persisted = []
+                self.size = self.persisted_size = 0
+                self.unlinked = False
+                if os.path.isfile(self.fullpath):
+                    st = os.stat(self.fullpath)
+                    self.times = (st.st_atime, st.st_mtime)
+                    manifest = read_manifest(self.fullpath)
+                    if manifest is not None:
+                        if manifest["chunk_size"] != self.cache.page_size:
+                            raise Exception("%s uses %d byte chunks, not %d" % (self.fullpath, manifest["chunk_size"], self.cache.page_size))
+                        self.chunks = manifest["chunks"]
+                        self.persisted = list(self.chunks)
+                        self.size = self.persisted_size = manifest["size"]
+                    else:
+                        self.import_plain()
+                else:
+                    self.manifest_dirty = True
+                self.is_loaded = True
+                if self.manifest_dirty:
+                    self.save_manifest()
+        return self
+
+    def import_plain(self):
+        ''' Chunk a file that was written before deduplication was enabled.
+        '''
+        with open(self.fullpath, "rb") as fh:
+            while True:
+                data = fh.read(self.cache.page_size)
+                if not data:
+                    break
+                self.size += len(data)
+                data = data.rstrip("\0")
+                digest = self.store.put(data) if data else None
+                if digest is not None:
+                    self.pinned.append(digest)
+                self.chunks.append(digest)
+        self.manifest_dirty = True
+
+    def unload(self):
+        with self.lock.writing():
+            self.writeback()
+            self.save_manifest()
+            super(DedupFileHandle, self).unload()
+            self.chunks = []
+            self.persisted = []
+
+    def load_page(self, index):
+        if index >= len(self.chunks) or self.chunks[index] is None:
+            return ""
+        return self.store.get(self.chunks[index])
+
+    def flush_page(self, index, page):
+        page_size = self.cache.page_size
+        if not self.dirty.ranges(index * page_size, (index + 1) * page_size):
+            return
+        # Store chunks in a canonical form, so identical file contents always
+        # give identical chunks: the bytes of the file that fall in the chunk
+        # without trailing zeros (which read back as a hole), and no chunk at
+        # all where they are all zero.
+        end = max([self.size] + self.dirty.ends[-1:]) - index * page_size
+        data = str(page[:end]).rstrip("\0")
+        digest = None
+        if data:
+            digest = self.store.put(data)
+            self.pinned.append(digest)
+        if index >= len(self.chunks):
+            self.chunks.extend([None] * (index + 1 - len(self.chunks)))
+        if self.chunks[index] != digest:
+            self.chunks[index] = digest
+            self.manifest_dirty = True
+
+    def resize(self, length):
+        page_size = self.cache.page_size
+        count = (length + page_size - 1) // page_size
+        if count < len(self.chunks):
+            del self.chunks[count:]
+        if length % page_size and count <= len(self.chunks):
+            # The new last chunk must be re-stored cut to the new length.
+            del self.page(count - 1)[length - (count - 1) * page_size:]
+            self.dirty.add((count - 1) * page_size, length)
+        self.manifest_dirty = True
+
+    def discard(self):
+        ''' The backing file was unlinked: drop every chunk reference and
+        never write the manifest again.
+        '''
+        with self.lock.writing():
+            self.unlinked = True
+            self.store.release(self.persisted + self.pinned)
+            self.persisted = []
+            self.pinned = []
+
+    def save_manifest(self):
+        if self.unlinked:
+            self.store.release(self.pinned)
+            self.pinned = []
+            return
+        # Zeros written past the end change the size but no chunk.
+        if not self.manifest_dirty and self.size == self.persisted_size:
+            return
+        del self.chunks[(self.size + self.cache.page_size - 1) // self.cache.page_size:]
+        write_atomically(self.fullpath, encode_manifest(self.size, self.cache.page_size, self.chunks))
+        # Reference the new chunk list before dropping the old one, so that
+        # chunks shared by both are never deleted.
+        self.store.acquire(self.chunks)
+        self.store.release(self.persisted + self.pinned)
+        self.persisted = list(self.chunks)
+        self.persisted_size = self.size
+        self.pinned = []
+        self.manifest_dirty = False
+
+    def sync(self):
+        self.save_manifest()
 
 # class RemoteFileHandle(FileHandle):
 #     def __init__(self, name, fullpath, fid, client):
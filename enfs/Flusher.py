@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import time
+import threading
+from collections import OrderedDict
+
+from common.Trace import *
+
+WRITEBACK_DELAY = 5.0
+DIRTY_LIMIT = 32 * 1024 * 1024
+
+class Flusher(threading.Thread):
+    ''' Background write-back of dirty FileHandles.
+
+    flush() only queues a handle; it is persisted once it has been queued
+    for `delay` seconds, or sooner if the queued handles hold more than
+    `dirty_limit` dirty bytes. Queuing a handle that is already pending is
+    a no-op, so bursts of flushes collapse into one write. sync() takes a
+    handle out of the queue and persists it before returning.
+
+    The queue holds an open reference to every handle in it, so closing a
+    queued file leaves it loaded with its dirty pages cached; the flusher
+    writes it back and fsyncs it, and only then drops the reference, which
+    unloads the handle if nothing else has it open.
+    '''
+    def __init__(self, delay = WRITEBACK_DELAY, dirty_limit = DIRTY_LIMIT):
+        super(Flusher, self).__init__(name = "enfs-flusher")
+        self.daemon = True
+        self.delay = delay
+        self.dirty_limit = dirty_limit
+        self.pending = OrderedDict()
+        self.cond = threading.Condition()
+        self.running = True
+
+    def dirty_bytes(self):
+        return sum(handle.dirty.total() for handle in self.pending)
+
+    def flush(self, handle):
+        with self.cond:
+            if handle not in self.pending:
+                handle.load()
+                self.pending[handle] = time.time() + self.delay
+            self.cond.notify()
+
+    def sync(self, handle):
+        with self.cond:
+            queued = self.pending.pop(handle, None) is not None
+        if queued:
+            self.persist(handle)
+        else:
+            handle.fsync()
+
+    def persist(self, handle):
+        ''' Write back and fsync a handle taken out of the queue, then drop
+        the queue's reference to it.
+        '''
+        try:
+            handle.fsync()
+        finally:
+            handle.close()
+
+    def stop(self):
+        ''' Persist everything still queued and wait for the thread to exit.
+        '''
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.join()
+
+    def take_due(self):
+        ''' Pop and return the handles that should be written now. Must be
+        called with the condition held.
+        '''
+        if not self.running or self.dirty_bytes() >= self.dirty_limit:
+            due = list(self.pending)
+        else:
+            now = time.time()
+            due = [handle for handle, deadline in self.pending.iteritems() if deadline <= now]
+        for handle in due:
+            del self.pending[handle]
+        return due
+
+    def run(self):
+        while True:
+            with self.cond:
+                due = self.take_due()
+                while not due and self.running:
+                    timeout = None
+                    if self.pending:
+                        timeout = max(0, self.pending.values()[0] - time.time())
+                    self.cond.wait(timeout)
+                    due = self.take_due()
+                if not due and not self.running:
+                    return
+            for handle in due:
+                try:
+                    self.persist(handle)
+                except Exception as e:
+                    TRACER.error("write-back of %s failed: %s", handle.fullpath, e)
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import heapq
+
+MAX_IDLE_FILES = 1024
+
+class OpenFile(object):
+    __slots__ = ("handle", "flags")
+
+    def __init__(self, handle, flags):
+        self.handle = handle
+        self.flags = flags
+
+class OpenFileTable(object):
+    ''' Maps file descriptors to the file each one has open. Like the
+    kernel's, released descriptors are reused lowest first, so the table
+    only ever holds as many entries as there are open files. It keeps a count
+    of opens per handle. The table does no locking; ContentStore guards it
+    with its own lock.
+    '''
+    def __init__(self):
+        self.entries = {}
+        self.free = []
+        self.next_fid = 0
+        self.counts = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, fid):
+        return fid in self.entries
+
+    def open(self, handle, flags):
+        if self.free:
+            fid = heapq.heappop(self.free)
+        else:
+            fid = self.next_fid
+            self.next_fid += 1
+        self.entries[fid] = OpenFile(handle, flags)
+        self.counts[handle] = self.counts.get(handle, 0) + 1
+        return fid
+
+    def get(self, fid):
+        return self.entries.get(fid)
+
+    def release(self, fid):
+        ''' Free `fid` and return the OpenFile it referred to.
+        '''
+        entry = self.entries.pop(fid)
+        heapq.heappush(self.free, fid)
+        count = self.counts[entry.handle] - 1
+        if count:
+            self.counts[entry.handle] = count
+        else:
+            del self.counts[entry.handle]
+        return entry
+
+    def count(self, handle):
+        ''' Return how many descriptors have `handle` open.
+        '''
+        return self.counts.get(handle, 0)
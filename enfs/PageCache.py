@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import threading
+from collections import OrderedDict
+
+PAGE_SIZE = 64 * 1024
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+class PageCache(object):
+    ''' Fixed-size page cache shared by every FileHandle in a ContentStore.
+
+    Pages are keyed by (handle, index) and kept in LRU order. Every resident
+    page is charged a full page_size against the budget; when the budget is
+    exceeded the least recently used pages are handed back to their handle
+    (which writes them back if dirty) and dropped. All methods are safe to
+    call from multiple threads.
+
+    Victims are chosen under the cache lock but written back after it is
+    released, so one file's writeback does not stall every page fault.
+    Until then they stay visible to lookup() in `evicting`.
+    '''
+    def __init__(self, budget = DEFAULT_CACHE_BYTES, page_size = PAGE_SIZE):
+        self.budget = max(budget, page_size)
+        self.page_size = page_size
+        self.pages = OrderedDict()
+        self.owners = {}
+        self.evicting = {}
+        self.used = 0
+        self.lock = threading.RLock()
+
+    def lookup(self, handle, index):
+        key = (handle, index)
+        with self.lock:
+            page = self.pages.pop(key, None)
+            if page is not None:
+                self.pages[key] = page
+                return page
+            return self.evicting.get(key)
+
+    def contains(self, handle, index):
+        ''' Return whether a page is resident, without touching LRU order.
+        '''
+        with self.lock:
+            return (handle, index) in self.pages or (handle, index) in self.evicting
+
+    def insert(self, handle, index, page):
+        key = (handle, index)
+        with self.lock:
+            if self.pages.pop(key, None) is None:
+                self.used += self.page_size
+                self.owners.setdefault(handle, set()).add(index)
+            self.pages[key] = page
+            victims = self.evict()
+        self.write_back(victims)
+
+    def _remove(self, handle, index):
+        if self.pages.pop((handle, index), None) is not None:
+            self.used -= self.page_size
+            resident = self.owners[handle]
+            resident.discard(index)
+            if not resident:
+                del self.owners[handle]
+
+    def drop(self, handle, first = 0):
+        ''' Drop every page of a handle at or after page index `first`,
+        without writing anything back.
+        '''
+        with self.lock:
+            for index in sorted(self.owners.get(handle, ())):
+                if index >= first:
+                    self._remove(handle, index)
+
+    def evict(self):
+        ''' Take LRU pages out of the cache until it is back under budget and
+        return them for write_back(). Must be called with the cache lock
+        held.
+
+        A page is only evicted if its handle's read lock can be taken without
+        blocking, which keeps writers from filling a page that is being
+        dropped; pages of write-locked handles are skipped and stay resident.
+        The read lock is held until the page is written back.
+        '''
+        victims = []
+        candidates = len(self.pages) - 1
+        while self.used > self.budget and candidates > 0:
+            candidates -= 1
+            (handle, index), page = self.pages.popitem(last = False)
+            if not handle.lock.acquire_read(False):
+                self.pages[(handle, index)] = page
+                continue
+            self.used -= self.page_size
+            resident = self.owners[handle]
+            resident.discard(index)
+            if not resident:
+                del self.owners[handle]
+            self.evicting[(handle, index)] = page
+            victims.append((handle, index, page))
+        return victims
+
+    def write_back(self, victims):
+        ''' Hand pages taken by evict() back to their handles. Must be called
+        without the cache lock held.
+        '''
+        for handle, index, page in victims:
+            try:
+                handle.evict_page(index, page)
+            finally:
+                with self.lock:
+                    self.evicting.pop((handle, index), None)
+                handle.lock.release_read()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import Queue
+import threading
+
+from common.Trace import *
+
+INITIAL_READAHEAD = 4 # pages
+MAX_READAHEAD = 64 # pages
+PREFETCH_WORKERS = 2
+PREFETCH_QUEUE = 64
+
+class ReadAhead(object):
+    ''' Access-pattern tracking for one handle.
+
+    A read that starts where the previous one ended continues a sequential
+    stream. While a stream lasts, observe() asks for the pages up to
+    `window` pages past the read to be prefetched, doubling the window each
+    time the prefetched region is reached, up to `max_window`. Any other
+    read ends the stream and resets the window.
+    '''
+    def __init__(self, initial_window = INITIAL_READAHEAD, max_window = MAX_READAHEAD):
+        self.initial_window = initial_window
+        self.max_window = max(max_window, initial_window)
+        self.next_offset = 0 # a read from the start counts as sequential
+        self.window = 0
+        self.prefetched = -1 # last page index already asked for
+        self.lock = threading.Lock()
+
+    def observe(self, offset, length, page_size, size):
+        ''' Record a read and return the page indices to prefetch.
+        '''
+        with self.lock:
+            sequential = offset == self.next_offset
+            self.next_offset = offset + length
+            if not sequential or length == 0 or offset >= size:
+                self.window = 0
+                self.prefetched = -1
+                return []
+            last = (min(offset + length, size) - 1) // page_size
+            if self.window == 0:
+                self.window = self.initial_window
+            elif last + self.window // 2 >= self.prefetched:
+                # The stream is catching up with what was prefetched.
+                self.window = min(self.window * 2, self.max_window)
+            else:
+                return []
+            end = min(last + self.window, (size - 1) // page_size)
+            first = max(last + 1, self.prefetched + 1)
+            self.prefetched = max(self.prefetched, end)
+            return range(first, end + 1)
+
+class Prefetcher(object):
+    ''' A few background threads that fault pages into the page cache ahead
+    of the readers that will need them. Requests beyond what the queue holds
+    are dropped; read-ahead is only ever a hint.
+    '''
+    def __init__(self, workers = PREFETCH_WORKERS, depth = PREFETCH_QUEUE):
+        self.queue = Queue.Queue(depth)
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run, name="prefetch-%d" % (i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, handle, indices):
+        if not indices:
+            return
+        try:
+            self.queue.put_nowait((handle, indices))
+        except Queue.Full:
+            pass
+
+    def run(self):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                return
+            handle, indices = request
+            try:
+                with handle.lock.reading():
+                    if handle.is_loaded:
+                        missing = [index for index in indices if not handle.cache.contains(handle, index)]
+                        handle.metrics.count("readahead.pages", len(missing))
+                        handle.fault_pages(missing)
+            except Exception as e:
+                TRACER.warn("prefetch of %s failed: %s", handle.fullpath, e)
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os
+import re
+import time
+import zlib
+import Queue
+import struct
+import threading
+
+from common.Metrics import *
+from common.Trace import *
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+SEGMENT_FILES = 256 # distinct files written per segment
+CHECKPOINT_INTERVAL = 5.0 # seconds
+QUEUE_BYTES = 32 * 1024 * 1024
+SEGMENT_PATTERN = re.compile(r"^segment\.(\d+)$")
+
+# crc32 of the rest, kind, name length, offset, data length; then the name
+# and the data. A rename carries the new name as its data.
+RECORD = struct.Struct(">IBHQI")
+WRITE, TRUNCATE, UNLINK, RENAME = range(1, 5)
+
+def encode_record(kind, name, offset, data = ""):
+    fields = RECORD.pack(0, kind, len(name), offset, len(data))[4:]
+    crc = zlib.crc32(data, zlib.crc32(name, zlib.crc32(fields))) & 0xffffffff
+    return struct.pack(">I", crc) + fields + name + data
+
+def read_records(path):
+    ''' Yield (kind, name, offset, data) for every record of the segment at
+    `path`, stopping at the first torn or corrupt one.
+    '''
+    with open(path, "rb") as fh:
+        while True:
+            header = fh.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            crc, kind, name_length, offset, length = RECORD.unpack(header)
+            name = fh.read(name_length)
+            data = fh.read(length)
+            if len(name) < name_length or len(data) < length or \
+               zlib.crc32(data, zlib.crc32(name, zlib.crc32(header[4:]))) & 0xffffffff != crc:
+                TRACER.warn("%s: ignoring a torn record and everything after it", path)
+                return
+            yield kind, name, offset, data
+
+def segments(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(match.group(1)) for match in map(SEGMENT_PATTERN.match, os.listdir(directory)) if match)
+
+def segment_path(directory, number):
+    return os.path.join(directory, "segment.%d" % (number))
+
+def under(name, prefix):
+    return name == prefix or name.startswith(prefix + "/")
+
+def recover_log(directory, root):
+    ''' Redo every write and truncate still in the log at `directory`
+    against the files below `root`, make them durable and drop the log.
+
+    Records are replayed per file in log order. Renames and unlinks in the
+    log decide which file a record belongs to; records of files that were
+    unlinked, or whose backing file no longer exists, are skipped.
+    '''
+    numbers = segments(directory)
+    if not numbers:
+        return 0
+    live = {}
+    count = 0
+    for number in numbers:
+        for kind, name, offset, data in read_records(segment_path(directory, number)):
+            count += 1
+            if kind in (WRITE, TRUNCATE):
+                live.setdefault(name, []).append((kind, offset, data))
+            elif kind == UNLINK:
+                for other in [other for other in live if under(other, name)]:
+                    del live[other]
+            elif kind == RENAME:
+                for other in [other for other in live if under(other, data)]:
+                    del live[other]
+                for other in [other for other in live if under(other, name)]:
+                    live[data + other[len(name):]] = live.pop(other)
+    for name, records in live.items():
+        path = os.path.join(root, name.lstrip("/"))
+        if not os.path.isfile(path):
+            continue
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            for kind, offset, data in records:
+                if kind == WRITE:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    os.write(fd, data)
+                else:
+                    os.ftruncate(fd, offset)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for number in numbers:
+        os.unlink(segment_path(directory, number))
+    TRACER.info("replayed %d log records into %d files", count, len(live))
+    return count
+
+class WriteAheadLog(threading.Thread):
+    ''' A redo log that makes fsync one sequential append and one os.fsync.
+
+    Every write and truncate a file handle makes to its backing file is also
+    appended here. The backing file writes are left to the kernel; fsync
+    only waits until the log is durable, and a single os.fsync of the log
+    covers every handle that synced meanwhile (group commit).
+
+    The log is kept in segments. Once a segment is big enough, or old
+    enough, a new one is started and the checkpointer fsyncs the files the
+    old segment wrote to, through descriptors duplicated when they were
+    first written, then deletes it. Whatever was not checkpointed before a
+    crash is redone by recover_log() at the next mount.
+    '''
+    def __init__(self, directory, segment_bytes = SEGMENT_BYTES, interval = CHECKPOINT_INTERVAL, metrics = NULL_METRICS):
+        super(WriteAheadLog, self).__init__(name = "enfs-wal")
+        self.daemon = True
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.interval = interval
+        self.metrics = metrics
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        numbers = segments(directory)
+        self.number = numbers[-1] + 1 if numbers else 0
+        self.log = open(segment_path(directory, self.number), "ab")
+        self.written = 0
+        self.started = time.time()
+        # Descriptors of the files written in the current segment, by
+        # (st_dev, st_ino), and the descriptor each name was last written
+        # through. A name that is unlinked or renamed over may come back as
+        # another inode, so unlinks and renames forget it.
+        self.fds = {}
+        self.names = {}
+        self.queue = []
+        self.queued_bytes = 0
+        self.appended = 0
+        self.durable = 0
+        self.syncing = 0
+        self.error = None
+        self.cond = threading.Condition()
+        self.running = True
+        self.checkpoints = Queue.Queue()
+        self.checkpointer = threading.Thread(target = self.checkpoint_loop, name = "enfs-checkpoint")
+        self.checkpointer.daemon = True
+        self.checkpointer.start()
+        self.start()
+
+    def append(self, record, name = None, fd = None, forget = ()):
+        with self.cond:
+            while self.queued_bytes >= QUEUE_BYTES and self.running:
+                self.cond.wait()
+            if fd is not None and self.names.get(name) != fd:
+                st = os.fstat(fd)
+                if (st.st_dev, st.st_ino) not in self.fds:
+                    self.fds[(st.st_dev, st.st_ino)] = os.dup(fd)
+                self.names[name] = fd
+            for prefix in forget:
+                for other in [other for other in self.names if under(other, prefix)]:
+                    del self.names[other]
+            self.queue.append(record)
+            self.queued_bytes += len(record)
+            self.appended += 1
+            if len(self.queue) == 1:
+                self.cond.notify_all()
+
+    def write(self, name, fd, offset, data):
+        self.append(encode_record(WRITE, name, offset, str(data)), name, fd)
+
+    def truncate(self, name, fd, length):
+        self.append(encode_record(TRUNCATE, name, length), name, fd)
+
+    def unlink(self, name):
+        self.append(encode_record(UNLINK, name, 0), forget = (name,))
+
+    def rename(self, old, new):
+        self.append(encode_record(RENAME, old, 0, new), forget = (old, new))
+
+    def sync(self):
+        ''' Return once everything appended so far is durable.
+        '''
+        with self.cond:
+            target = self.appended
+            self.syncing += 1
+            self.cond.notify_all()
+            while self.durable < target and self.is_alive() and self.error is None:
+                self.cond.wait(self.interval)
+            self.syncing -= 1
+            if self.durable < target:
+                raise Exception("write-ahead log is not durable: %s" % (self.error))
+
+    def stop(self):
+        ''' Make everything durable, checkpoint it and wait for both threads
+        to exit; a cleanly stopped log leaves nothing to recover.
+        '''
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.join()
+        self.checkpoints.put(None)
+        self.checkpointer.join()
+
+    def due(self):
+        ''' Whether the current segment should be checkpointed. Must be
+        called with the condition held.
+        '''
+        if not self.running or len(self.fds) >= SEGMENT_FILES or self.written >= self.segment_bytes:
+            return True
+        return self.written > 0 and time.time() - self.started >= self.interval
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue and not self.due() and \
+                      not (self.syncing and self.durable < self.appended):
+                    self.cond.wait(self.interval)
+                batch, self.queue = self.queue, []
+                self.queued_bytes = 0
+                target = self.appended
+                sync = self.syncing > 0 or not self.running
+                # Records appended from now on go to the next segment.
+                rotate = self.due()
+                if rotate:
+                    fds, self.fds = self.fds, {}
+                    self.names = {}
+                running = self.running
+                self.cond.notify_all()
+            try:
+                if batch:
+                    data = "".join(batch)
+                    self.log.write(data)
+                    self.written += len(data)
+                    self.metrics.count("wal.bytes", len(data))
+                if sync or rotate:
+                    with self.metrics.timing("wal.commit"):
+                        self.log.flush()
+                        os.fsync(self.log.fileno())
+                if sync or rotate:
+                    with self.cond:
+                        self.durable = target
+            except Exception as e:
+                TRACER.error("write-ahead log append failed: %s", e)
+                with self.cond:
+                    self.error = e
+            with self.cond:
+                self.cond.notify_all()
+            if rotate:
+                self.rotate(fds, running)
+            if not running:
+                return
+
+    def rotate(self, fds, reopen = True):
+        ''' Hand the current segment to the checkpointer (or drop it if it
+        is empty) and start the next one.
+        '''
+        self.log.close()
+        if self.written and self.error is None:
+            self.checkpoints.put((segment_path(self.directory, self.number), fds))
+            self.number += 1
+        else:
+            for fd in fds.values():
+                os.close(fd)
+            if not self.written:
+                os.unlink(segment_path(self.directory, self.number))
+        if reopen:
+            self.log = open(segment_path(self.directory, self.number), "ab")
+        self.written = 0
+        self.started = time.time()
+
+    def checkpoint_loop(self):
+        while True:
+            request = self.checkpoints.get()
+            if request is None:
+                return
+            path, fds = request
+            try:
+                with self.metrics.timing("wal.checkpoint"):
+                    for fd in fds.values():
+                        os.fsync(fd)
+                    os.unlink(path)
+            except Exception as e:
+                TRACER.error("checkpoint of %s failed: %s", path, e)
+            finally:
+                for fd in fds.values():
+                    os.close(fd)
@@ -0,0 +1,450 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+''' Benchmark the file systems' FUSE operations with synthetic workloads.
+
+Each target (enfs, enfs with encryption, and CCNxDrive) is driven either
+in-process, by calling its Operations object the way fusepy does, or
+through a real mount on a temporary directory. enfs and src both define
+modules such as ContentStore, so every target and mode runs in a child
+process of its own. The results, throughput and p50/p99 latency per
+workload, are printed as JSON.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from common.Metrics import Histogram
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CCNX_DIR = os.path.join(os.path.dirname(HERE), "src")
+
+TARGETS = ("enfs", "enfs-encrypted", "enfs-compressed", "ccnx")
+# Codec of the enfs-compressed target, an encrypted mount.
+COMPRESSION = "zlib"
+MODES = ("inprocess", "mount")
+WORKLOADS = ("seq_write", "seq_read", "rand_write", "rand_read", "metadata", "small_files", "large_flush")
+# CCNxDrive serves remote objects read-only.
+CCNX_WORKLOADS = ("seq_read", "rand_read")
+BLOCK_SIZES = "4096,65536,1048576"
+PASSPHRASE = "benchmark"
+SMALL_FILE_SIZE = 4096
+FLUSH_BLOCK = 1024 * 1024
+
+def wait_for_mount(mountpoint, fs, timeout = 10):
+    deadline = time.time() + timeout
+    while not os.path.ismount(mountpoint):
+        if fs.poll() is not None:
+            raise Exception("the file system exited with status %d before mounting" % (fs.returncode))
+        if time.time() > deadline:
+            raise Exception("%s was not mounted after %d seconds" % (mountpoint, timeout))
+        time.sleep(0.1)
+
+class Run(object):
+    ''' Times the operations of one workload: every operation goes into a
+    latency histogram, and the whole run gives the throughput.
+    '''
+    def __init__(self, workload, **params):
+        self.workload = workload
+        self.params = params
+        self.histogram = Histogram()
+        self.bytes = 0
+        self.started = time.time()
+        self.elapsed = None
+
+    def time(self, nbytes, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.histogram.record((time.time() - start) * 1e6)
+        self.bytes += nbytes
+        return result
+
+    def finish(self):
+        self.elapsed = time.time() - self.started
+        return self
+
+    def result(self):
+        elapsed = self.elapsed or time.time() - self.started
+        result = dict(self.params)
+        result.update({
+            "workload": self.workload,
+            "ops": self.histogram.count,
+            "seconds": round(elapsed, 6),
+            "ops_s": round(self.histogram.count / elapsed, 1) if elapsed else None,
+            "p50_us": self.histogram.percentile(50),
+            "p99_us": self.histogram.percentile(99),
+            "max_us": self.histogram.max,
+        })
+        if self.bytes:
+            result["mb_s"] = round(self.bytes / elapsed / (1024 * 1024), 2) if elapsed else None
+        return result
+
+class OperationsDriver(object):
+    ''' Calls an Operations object directly, through __call__ as fusepy
+    does, so per-op metrics and tracing are included.
+    '''
+    def __init__(self, fs):
+        self.fs = fs
+        self.populated = set()
+
+    def create(self, path):
+        return self.fs("create", path, 0644)
+
+    def open(self, path, flags):
+        return self.fs("open", path, flags)
+
+    def read(self, path, fh, offset, length):
+        return self.fs("read", path, length, offset, fh)
+
+    def write(self, path, fh, data, offset):
+        return self.fs("write", path, data, offset, fh)
+
+    def fsync(self, path, fh):
+        return self.fs("fsync", path, 0, fh)
+
+    def release(self, path, fh):
+        self.fs("flush", path, fh)
+        return self.fs("release", path, fh)
+
+    def stat(self, path):
+        return self.fs("getattr", path)
+
+    def unlink(self, path):
+        return self.fs("unlink", path)
+
+    def populate(self, path, size, data):
+        ''' Make sure `path` holds `size` bytes, without timing it.
+        '''
+        if path in self.populated:
+            return
+        fh = self.create(path)
+        for offset in range(0, size, len(data)):
+            self.write(path, fh, data, offset)
+        self.release(path, fh)
+        self.populated.add(path)
+
+    def close(self):
+        self.fs("destroy", "/")
+
+class RemoteDriver(OperationsDriver):
+    ''' Drives CCNxDrive, whose files are remote objects: they are populated
+    by seeding the drive's remote cache, so reads measure the drive rather
+    than the network.
+    '''
+    def populate(self, path, size, data):
+        if path in self.populated:
+            return
+        payload = (data * (size // len(data) + 1))[:size]
+        self.fs.content_store.remote_cache.put(path, payload, 365 * 24 * 3600)
+        self.populated.add(path)
+
+class MountDriver(OperationsDriver):
+    ''' Issues the same operations as system calls on a mount point.
+    '''
+    def __init__(self, mountpoint):
+        super(MountDriver, self).__init__(None)
+        self.mountpoint = mountpoint
+
+    def _full_path(self, path):
+        return os.path.join(self.mountpoint, path.lstrip("/"))
+
+    def create(self, path):
+        return os.open(self._full_path(path), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+
+    def open(self, path, flags):
+        return os.open(self._full_path(path), flags)
+
+    def read(self, path, fh, offset, length):
+        os.lseek(fh, offset, os.SEEK_SET)
+        return os.read(fh, length)
+
+    def write(self, path, fh, data, offset):
+        os.lseek(fh, offset, os.SEEK_SET)
+        return os.write(fh, data)
+
+    def fsync(self, path, fh):
+        return os.fsync(fh)
+
+    def release(self, path, fh):
+        return os.close(fh)
+
+    def stat(self, path):
+        return os.stat(self._full_path(path))
+
+    def unlink(self, path):
+        return os.unlink(self._full_path(path))
+
+    def close(self):
+        pass
+
+def seq_write(driver, options, block, data):
+    path = "/seq-%d" % (block)
+    run = Run("seq_write", block = block)
+    fh = driver.create(path)
+    for offset in range(0, options.size, block):
+        run.time(block, driver.write, path, fh, data, offset)
+    driver.release(path, fh)
+    driver.populated.add(path)
+    return [run.finish().result()]
+
+def seq_read(driver, options, block, data):
+    path = "/seq-%d" % (block)
+    driver.populate(path, options.size, data)
+    run = Run("seq_read", block = block)
+    fh = driver.open(path, os.O_RDONLY)
+    for offset in range(0, options.size, block):
+        run.time(block, driver.read, path, fh, offset, block)
+    driver.release(path, fh)
+    return [run.finish().result()]
+
+def random_offsets(options, block):
+    rng = random.Random(options.seed)
+    blocks = max(options.size // block, 1)
+    return [rng.randrange(blocks) * block for i in range(options.random_ops)]
+
+def rand_write(driver, options, block, data):
+    path = "/seq-%d" % (block)
+    driver.populate(path, options.size, data)
+    run = Run("rand_write", block = block)
+    fh = driver.open(path, os.O_RDWR)
+    for offset in random_offsets(options, block):
+        run.time(block, driver.write, path, fh, data, offset)
+    driver.release(path, fh)
+    return [run.finish().result()]
+
+def rand_read(driver, options, block, data):
+    path = "/seq-%d" % (block)
+    driver.populate(path, options.size, data)
+    run = Run("rand_read", block = block)
+    fh = driver.open(path, os.O_RDONLY)
+    for offset in random_offsets(options, block):
+        run.time(block, driver.read, path, fh, offset, block)
+    driver.release(path, fh)
+    return [run.finish().result()]
+
+def create_file(driver, path):
+    driver.release(path, driver.create(path))
+
+def metadata(driver, options):
+    ''' A create/stat/unlink storm over options.files empty files.
+    '''
+    paths = ["/meta-%d" % (i) for i in range(options.files)]
+    runs = []
+    for workload, op in (("meta_create", lambda path: create_file(driver, path)),
+                         ("meta_stat", driver.stat), ("meta_unlink", driver.unlink)):
+        run = Run(workload, files = options.files)
+        for path in paths:
+            run.time(0, op, path)
+        runs.append(run.finish().result())
+    return runs
+
+def write_small(driver, path, data):
+    fh = driver.create(path)
+    driver.write(path, fh, data, 0)
+    driver.release(path, fh)
+
+def read_small(driver, path, size):
+    fh = driver.open(path, os.O_RDONLY)
+    data = driver.read(path, fh, 0, size)
+    driver.release(path, fh)
+    return data
+
+def small_files(driver, options, data):
+    ''' Write and read back many small files, one open and close each.
+    '''
+    data = data[:SMALL_FILE_SIZE]
+    paths = ["/small-%d" % (i) for i in range(options.small_files)]
+    write = Run("small_write", files = options.small_files, size = len(data))
+    for path in paths:
+        write.time(len(data), write_small, driver, path, data)
+    write.finish()
+    read = Run("small_read", files = options.small_files, size = len(data))
+    for path in paths:
+        read.time(len(data), read_small, driver, path, len(data))
+    read.finish()
+    for path in paths:
+        driver.unlink(path)
+    return [write.result(), read.result()]
+
+def large_flush(driver, options, data):
+    ''' Write a large file and time the fsync that pushes (and, on an
+    encrypted mount, seals) it.
+    '''
+    path = "/flush"
+    size = options.flush_mb * 1024 * 1024
+    data = (data * (FLUSH_BLOCK // len(data) + 1))[:FLUSH_BLOCK]
+    fh = driver.create(path)
+    for offset in range(0, size, FLUSH_BLOCK):
+        driver.write(path, fh, data, offset)
+    run = Run("large_flush", size_mb = options.flush_mb)
+    run.time(size, driver.fsync, path, fh)
+    run.finish()
+    driver.release(path, fh)
+    driver.unlink(path)
+    return [run.result()]
+
+def run_workloads(driver, options, workloads):
+    block_sizes = [int(block) for block in options.block_sizes.split(",")]
+    size = max(block_sizes + [SMALL_FILE_SIZE])
+    if options.compressible:
+        # Half random, half zeros: compresses to a little over half.
+        pattern = "".join(os.urandom(512) + "\0" * 512 for _ in range(size // 1024 + 1))[:size]
+    else:
+        pattern = os.urandom(size)
+    results = []
+    for workload in workloads:
+        if workload in ("seq_write", "seq_read", "rand_write", "rand_read"):
+            for block in block_sizes:
+                results.extend(globals()[workload](driver, options, block, pattern[:block]))
+        elif workload == "metadata":
+            results.extend(metadata(driver, options))
+        else:
+            results.extend(globals()[workload](driver, options, pattern))
+    return results
+
+def start_enfs(root, encrypted, compression = None):
+    ''' Build an in-process enfs facade.
+    '''
+    from enfs import FileSystemFacade
+    return OperationsDriver(FileSystemFacade(root, passphrase = PASSPHRASE if encrypted else None,
+                                             compression = compression))
+
+def start_ccnx(root):
+    ''' Build an in-process CCNxDrive. Its modules shadow enfs's, so this
+    must run in a process that has not imported the enfs store.
+    '''
+    if HERE in sys.path:
+        sys.path.remove(HERE)
+    sys.path.insert(0, CCNX_DIR)
+    from CCNxDrive import CCNxDrive
+    return RemoteDriver(CCNxDrive(root))
+
+def mount_enfs(root, mountpoint, encrypted, threaded, compression = None):
+    command = [sys.executable, os.path.join(HERE, "enfs.py"), root, mountpoint]
+    if threaded:
+        command.append("--threaded")
+    if encrypted:
+        command.append("--encrypt")
+    if compression is not None:
+        command.extend(["--compress", compression])
+    env = dict(os.environ, ENFS_PASSPHRASE = PASSPHRASE)
+    return subprocess.Popen(command, env = env, stdout = open(os.devnull, "w"))
+
+def run_target(target, mode, options):
+    ''' Benchmark one target in one mode; runs in its own process.
+    '''
+    workloads = [workload for workload in options.workloads.split(",")
+                 if target != "ccnx" or workload in CCNX_WORKLOADS]
+    if target == "ccnx" and mode == "mount":
+        # The kernel needs st_mode from getattr before it opens a file, and
+        # CCNxDrive only reports attributes for its stats file.
+        return [{"skipped": "CCNxDrive.getattr does not describe remote files, so they cannot be opened through a mount"}]
+
+    encrypted = target in ("enfs-encrypted", "enfs-compressed")
+    compression = COMPRESSION if target == "enfs-compressed" else None
+    root = tempfile.mkdtemp(prefix="enfs-bench-root-")
+    mountpoint = None
+    fs = None
+    try:
+        if mode == "inprocess":
+            if target == "ccnx":
+                driver = start_ccnx(root)
+            else:
+                driver = start_enfs(root, encrypted, compression)
+        else:
+            mountpoint = tempfile.mkdtemp(prefix="enfs-bench-mount-")
+            fs = mount_enfs(root, mountpoint, encrypted, options.threaded, compression)
+            wait_for_mount(mountpoint, fs)
+            driver = MountDriver(mountpoint)
+        try:
+            return run_workloads(driver, options, workloads)
+        finally:
+            driver.close()
+    finally:
+        if fs is not None:
+            if os.path.ismount(mountpoint):
+                subprocess.call(["fusermount", "-u", mountpoint])
+            elif fs.poll() is None:
+                fs.terminate()
+            fs.wait()
+        if mountpoint is not None:
+            os.rmdir(mountpoint)
+        shutil.rmtree(root)
+
+def spawn(target, mode, argv):
+    ''' Run one target and mode in a child process and return its results.
+    '''
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", target, mode] + argv,
+        stdout = subprocess.PIPE)
+    output = child.communicate()[0]
+    if child.returncode != 0:
+        results = [{"error": "benchmark exited with status %d" % (child.returncode)}]
+    else:
+        results = json.loads(output)
+    for result in results:
+        result.update({"target": target, "mode": mode})
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='enfs-bench', description='Benchmark FUSE operations of enfs and CCNxDrive.')
+    parser.add_argument('--targets', action="store", default=",".join(TARGETS),
+        help="Comma-separated targets among %s." % (", ".join(TARGETS)))
+    parser.add_argument('--modes', action="store", default=",".join(MODES),
+        help="Comma-separated ways to drive each target: inprocess calls its Operations, mount goes through FUSE.")
+    parser.add_argument('--workloads', action="store", default=",".join(WORKLOADS),
+        help="Comma-separated workloads among %s." % (", ".join(WORKLOADS)))
+    parser.add_argument('-b', '--block-sizes', action="store", default=BLOCK_SIZES,
+        help="Comma-separated I/O sizes in bytes for the read and write workloads.")
+    parser.add_argument('-s', '--size', action="store", type=int, default=64 * 1024 * 1024,
+        help="Bytes in the file the read and write workloads use.")
+    parser.add_argument('-n', '--random-ops', action="store", type=int, default=2000,
+        help="Operations per random read or write workload.")
+    parser.add_argument('--files', action="store", type=int, default=100000,
+        help="Files created, stat'ed and unlinked by the metadata workload.")
+    parser.add_argument('--small-files', action="store", type=int, default=10000,
+        help="Files written and read back by the small-files workload.")
+    parser.add_argument('--flush-mb', action="store", type=int, default=256,
+        help="MiB written before the timed fsync of the large-flush workload.")
+    parser.add_argument('--compressible', action="store_true",
+        help="Write half-zero data instead of random bytes, so compressed targets have something to compress.")
+    parser.add_argument('-t', '--threaded', action="store_true", help="Mount in threaded mode.")
+    parser.add_argument('--seed', action="store", type=int, default=0, help="Seed for random offsets.")
+    parser.add_argument('-o', '--output', action="store", default=None, help="Write the JSON report here instead of stdout.")
+    parser.add_argument('--child', action="store", nargs=2, default=None, help=argparse.SUPPRESS)
+
+    argv = sys.argv[1:]
+    args = parser.parse_args()
+
+    if args.child:
+        # Keep stdout for the results whatever the targets write there.
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        results = run_target(args.child[0], args.child[1], args)
+        stdout.write(json.dumps(results))
+        sys.exit(0)
+
+    report = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "options": dict((key, value) for key, value in vars(args).items() if key not in ("child", "output")),
+        "results": [],
+    }
+    for target in args.targets.split(","):
+        for mode in args.modes.split(","):
+            report["results"].extend(spawn(target, mode, argv))
+
+    output = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output + "\n")
+    else:
+        print output
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+''' Measure encrypted flush and cold-read throughput of the ContentStore
+for a range of crypto pool sizes.
+'''
+
+import os
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+from ContentStore import *
+
+def bench(workers, size, block = 1024 * 1024):
+    root = tempfile.mkdtemp(prefix="enfs-bench-")
+    try:
+        # Keep the whole file resident so the flush is what gets measured.
+        store = ContentStore(root, size + 16 * PAGE_SIZE, "benchmark", crypto_workers = workers)
+        try:
+            handle = store.create_local_file("/blob", 0644).load()
+            data = os.urandom(block)
+            for offset in range(0, size, block):
+                handle.write(data, offset)
+
+            start = time.time()
+            handle.fsync()
+            flush = time.time() - start
+            handle.close()
+
+            handle.load()
+            start = time.time()
+            for offset in range(0, size, block):
+                handle.read(offset, block)
+            read = time.time() - start
+            handle.close()
+        finally:
+            store.close()
+    finally:
+        shutil.rmtree(root)
+
+    mb = size / float(1024 * 1024)
+    return {"workers": workers, "size_mb": mb, "flush_mb_s": mb / flush, "read_mb_s": mb / read}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='enfs-bench-crypto', description='Benchmark chunk sealing across crypto pool sizes.')
+    parser.add_argument('-w', '--max-workers', action="store", type=int, default=multiprocessing.cpu_count(),
+        help="Largest pool size to try; every size from 1 up is measured.")
+    parser.add_argument('-s', '--sizes', action="store", default="100,1024", help="Comma-separated file sizes in MiB.")
+
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        for workers in range(1, args.max_workers + 1):
+            results.append(bench(workers, size * 1024 * 1024))
+
+    print json.dumps(results, indent=2)
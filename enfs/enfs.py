@@ -3,14 +3,108 @@ from __future__ import with_statement
 import os
 import sys
 import errno
+import argparse
+import getpass
+import stat
+import threading
+import time
 from ContentStore import *
+from AttrCache import *
+from common.Trace import *
 
 from fuse import FUSE, FuseOSError, Operations
 
+# A read-only virtual file with the mount's metrics as JSON.
+STATS_PATH = "/%s/stats" % (META_DIR)
+STATS_BLOCK = 4096
+# A read-only virtual file with the most recent operations from the trace ring.
+TRACE_PATH = "/%s/trace" % (META_DIR)
+VIRTUAL_FILES = (STATS_PATH, TRACE_PATH)
+# The store's own state under META_DIR is out of reach of the mount: only
+# the directory itself and the virtual files in it can be looked up, and
+# nothing there can be changed.
+PRIVATE_DIR = "/%s" % (META_DIR)
+LOOKUP_OPS = frozenset(["access", "flush", "fsync", "getattr", "getxattr", "listxattr", "open", "opendir",
+                        "read", "readdir", "readlink", "release", "releasedir", "statfs"])
+# Operations whose second argument is a path under the mount as well.
+TWO_PATH_OPS = frozenset(["link", "rename", "symlink"])
+# Descriptors of open virtual files start here, far above the store's own.
+VIRTUAL_FH_BASE = 1 << 32
+
+def ratio(hits, misses):
+    return round(float(hits) / (hits + misses), 4) if hits + misses else None
+
 class FileSystemFacade(Operations):
-    def __init__(self, root):
+    def __init__(self, root, attr_ttl = ATTR_TTL, **store_options):
         self.root = root
-        self.content_store = ContentStore(root)
+        self.content_store = ContentStore(root, **store_options)
+        # Invalidated after every change rather than before, so a getattr
+        # racing with it in threaded mode cannot re-cache what it replaced.
+        self.attr_cache = AttrCache(attr_ttl)
+        self.metrics = self.content_store.metrics
+        # The contents of every open virtual file, by descriptor: open()
+        # takes one snapshot and every read and fgetattr is served from it.
+        self.snapshots = {}
+        self.snapshot_seq = VIRTUAL_FH_BASE
+        self.snapshot_lock = threading.Lock()
+        self.metrics.gauge("attr_cache_hit_ratio", lambda: ratio(self.attr_cache.hits, self.attr_cache.misses))
+        self.metrics.gauge("page_cache_hit_ratio", lambda: ratio(self.metrics.counters.get("page_cache.hits", 0),
+                                                                 self.metrics.counters.get("page_cache.misses", 0)))
+
+    def __call__(self, op, *args):
+        if TRACER.enabled(DEBUG):
+            TRACER.emit("%s(%s)" % (op, display_args(args)))
+        start = time.time()
+        try:
+            self.check_private(op, args[:2] if op in TWO_PATH_OPS else args[:1])
+            return super(FileSystemFacade, self).__call__(op, *args)
+        except OSError as e:
+            self.metrics.count("errors." + op)
+            TRACER.info("%s %s failed: %s", op, args[0] if args else "", e)
+            raise
+        finally:
+            elapsed = time.time() - start
+            self.metrics.record("op." + op, elapsed)
+            if TRACER.ring_size and args and isinstance(args[0], str) and args[0] not in VIRTUAL_FILES:
+                offset, length = extent_of(op, args)
+                TRACER.record(op, args[0], offset, length, elapsed)
+
+    def check_private(self, op, paths):
+        for path in paths:
+            if not isinstance(path, str) or (path != PRIVATE_DIR and not path.startswith(PRIVATE_DIR + "/")):
+                continue
+            if op not in LOOKUP_OPS:
+                raise FuseOSError(errno.EACCES)
+            if path != PRIVATE_DIR and path not in VIRTUAL_FILES:
+                raise FuseOSError(errno.ENOENT)
+
+    def virtual_file(self, path):
+        ''' The contents of a virtual file, padded with blanks to a whole
+        block so its size changes rarely between getattr and read.
+        '''
+        data = self.stats() if path == STATS_PATH else TRACER.dump_text()
+        size = (len(data) // STATS_BLOCK + 1) * STATS_BLOCK
+        return data + " " * (size - len(data) - 1) + "\n"
+
+    def open_virtual(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise FuseOSError(errno.EACCES)
+        data = self.virtual_file(path)
+        with self.snapshot_lock:
+            fh = self.snapshot_seq
+            self.snapshot_seq += 1
+            self.snapshots[fh] = data
+        return fh
+
+    def snapshot(self, path, fh):
+        ''' The contents virtual file descriptor `fh` serves, or a fresh copy
+        for a request that names no descriptor.
+        '''
+        data = self.snapshots.get(fh) if fh is not None else None
+        return data if data is not None else self.virtual_file(path)
+
+    def stats(self):
+        return self.metrics.to_json()
 
     def _full_path(self, partial):
         if partial.startswith("/"):
@@ -18,31 +112,93 @@ class FileSystemFacade(Operations):
         path = os.path.join(self.root, partial)
         return path
 
+    # Modes and owners live in the metadata journal, so permission checks
+    # are made against getattr() rather than the backing files, with the
+    # credentials of the mounting process as os.access() and os.chown() did.
+    def _permitted(self, attrs, mode):
+        bits = mode & (os.R_OK | os.W_OK | os.X_OK)
+        if os.geteuid() == 0:
+            return not (bits & os.X_OK) or stat.S_ISDIR(attrs['st_mode']) or attrs['st_mode'] & 0111
+        if attrs['st_uid'] == os.geteuid():
+            allowed = (attrs['st_mode'] >> 6) & 07
+        elif attrs['st_gid'] in self._groups():
+            allowed = (attrs['st_mode'] >> 3) & 07
+        else:
+            allowed = attrs['st_mode'] & 07
+        return bits & allowed == bits
+
+    def _groups(self):
+        return set([os.getegid()] + os.getgroups())
+
+    def _check_owner(self, attrs):
+        if os.geteuid() != 0 and attrs['st_uid'] != os.geteuid():
+            raise FuseOSError(errno.EPERM)
+
     def access(self, path, mode):
-        full_path = self._full_path(path)
-        if not os.access(full_path, mode):
+        attrs = self.getattr(path)
+        if not self._permitted(attrs, mode):
             raise FuseOSError(errno.EACCES)
 
+    # Attribute changes go to the store's metadata journal rather than the
+    # backing files, which must stay readable and writable by the store.
     def chmod(self, path, mode):
-        full_path = self._full_path(path)
-        return os.chmod(full_path, mode)
+        self._check_owner(self.getattr(path))
+        try:
+            self.content_store.chmod(path, mode)
+        finally:
+            self.attr_cache.invalidate(path)
 
     def chown(self, path, uid, gid):
-        full_path = self._full_path(path)
-        return os.chown(full_path, uid, gid)
+        attrs = self.getattr(path)
+        if os.geteuid() != 0:
+            # Only root may give a file away; an owner may change its group
+            # to one of its own groups.
+            self._check_owner(attrs)
+            if uid != -1 and uid != attrs['st_uid']:
+                raise FuseOSError(errno.EPERM)
+            if gid != -1 and gid != attrs['st_gid'] and gid not in self._groups():
+                raise FuseOSError(errno.EPERM)
+        try:
+            self.content_store.chown(path, uid, gid)
+        finally:
+            self.attr_cache.invalidate(path)
 
     def getattr(self, path, fh=None):
-        full_path = self._full_path(path)
-        st = os.lstat(full_path)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                     'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        if path in VIRTUAL_FILES:
+            now = time.time()
+            return {'st_mode': stat.S_IFREG | 0444, 'st_nlink': 1, 'st_size': len(self.snapshot(path, fh)),
+                    'st_uid': os.getuid(), 'st_gid': os.getgid(), 'st_atime': now, 'st_mtime': now, 'st_ctime': now}
+        attrs = self.attr_cache.get_attr(path)
+        if attrs is None:
+            full_path = self._full_path(path)
+            st = os.lstat(full_path)
+            attrs = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+                         'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+            if stat.S_ISREG(st.st_mode):
+                attrs['st_size'] = self.content_store.file_size(path, st.st_size)
+            self.content_store.attributes(path, attrs)
+            self.attr_cache.put_attr(path, attrs)
+
+        # An open file knows its own size and times better than the disk.
+        handle = self.content_store.loaded_handle(path)
+        if handle is not None:
+            attrs = dict(attrs)
+            attrs['st_size'] = handle.size
+            attrs['st_atime'], attrs['st_mtime'] = handle.times
+        return attrs
 
     def readdir(self, path, fh):
-        full_path = self._full_path(path)
-
-        dirents = ['.', '..']
-        if os.path.isdir(full_path):
-            dirents.extend(os.listdir(full_path))
+        dirents = self.attr_cache.get_dir(path)
+        if dirents is None:
+            full_path = self._full_path(path)
+            dirents = ['.', '..']
+            if path == PRIVATE_DIR:
+                dirents.extend(os.path.basename(virtual) for virtual in VIRTUAL_FILES)
+            elif os.path.isdir(full_path):
+                dirents.extend(os.listdir(full_path))
+            if path == "/" and META_DIR in dirents:
+                dirents.remove(META_DIR)
+            self.attr_cache.put_dir(path, dirents)
         for r in dirents:
             yield r
 
@@ -55,14 +211,24 @@ class FileSystemFacade(Operations):
             return pathname
 
     def mknod(self, path, mode, dev):
-        return os.mknod(self._full_path(path), mode, dev)
+        try:
+            return os.mknod(self._full_path(path), mode, dev)
+        finally:
+            self.attr_cache.invalidate(path, True)
 
     def rmdir(self, path):
         full_path = self._full_path(path)
-        return os.rmdir(full_path)
+        try:
+            os.rmdir(full_path)
+            self.content_store.forget(path)
+        finally:
+            self.attr_cache.invalidate_tree(path)
 
     def mkdir(self, path, mode):
-        return os.mkdir(self._full_path(path), mode)
+        try:
+            return os.mkdir(self._full_path(path), mode)
+        finally:
+            self.attr_cache.invalidate(path, True)
 
     def statfs(self, path):
         full_path = self._full_path(path)
@@ -72,79 +238,173 @@ class FileSystemFacade(Operations):
             'f_frsize', 'f_namemax'))
 
     def unlink(self, path):
-        return os.unlink(self._full_path(path))
+        try:
+            self.content_store.discard(path)
+            if self.content_store.contains_file(path):
+                self.content_store.unlink(path)
+            os.unlink(self._full_path(path))
+            self.content_store.forget(path)
+        finally:
+            self.attr_cache.invalidate(path, True)
 
     def symlink(self, name, target):
-        return os.symlink(name, self._full_path(target))
+        try:
+            return os.symlink(name, self._full_path(target))
+        finally:
+            self.attr_cache.invalidate(target, True)
 
     def rename(self, old, new):
-        return os.rename(self._full_path(old), self._full_path(new))
+        try:
+            os.rename(self._full_path(old), self._full_path(new))
+            self.content_store.rename(old, new)
+        finally:
+            self.attr_cache.invalidate_tree(old)
+            self.attr_cache.invalidate_tree(new)
 
     def link(self, target, name):
-        return os.link(self._full_path(target), self._full_path(name))
+        try:
+            return os.link(self._full_path(target), self._full_path(name))
+        finally:
+            self.attr_cache.invalidate(target)
+            self.attr_cache.invalidate(name, True)
 
     def utimens(self, path, times=None):
-        return os.utime(self._full_path(path), times)
+        attrs = self.getattr(path)
+        if times is not None or not self._permitted(attrs, os.W_OK):
+            self._check_owner(attrs)
+        try:
+            self.content_store.utime(path, times)
+        finally:
+            self.attr_cache.invalidate(path)
 
     def open(self, path, flags):
-        print "open"
         # full_path = self._full_path(path)
         # fid = os.open(full_path, flags)
 
-        handle = self.content_store.open(path, flags)
-
-        return handle
+        if path in VIRTUAL_FILES:
+            return self.open_virtual(path, flags)
+        return self.content_store.open(path, flags)
 
     def create(self, path, mode, fi=None):
-        print "create"
-
         # full_path = self._full_path(path)
         # fid = os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
-        handle = self.content_store.create_local_file(path, mode)
-
-        return handle.fid
+        try:
+            return self.content_store.create(path, mode)
+        finally:
+            self.attr_cache.invalidate(path, True)
 
     def read(self, path, length, offset, fh):
-        print "read %s" % (path)
+        if path in VIRTUAL_FILES:
+            return self.snapshot(path, fh)[offset:offset + length]
         handle = self.content_store.get_handle(fh)
-        return handle.read(offset, length)
+        data = handle.read(offset, length)
+        self.metrics.count("bytes.read", len(data))
+        return data
         # os.lseek(fh, offset, os.SEEK_SET)
         # return os.read(fh, length)
 
     def write(self, path, buf, offset, fh):
-        print "write"
         # os.lseek(fh, offset, os.SEEK_SET)
         # return os.write(fh, buf)
         handle = self.content_store.get_handle(fh)
-        return handle.write(buf, offset)
+        self.metrics.count("bytes.written", len(buf))
+        try:
+            return handle.write(buf, offset)
+        finally:
+            self.attr_cache.invalidate(path)
 
     def truncate(self, path, length, fh=None):
-        print "truncate"
-        # full_path = self._full_path(path)
-        # with open(full_path, 'r+') as f:
-        #     f.truncate(length)
+        try:
+            self.content_store.truncate(path, length, fh)
+        finally:
+            self.attr_cache.invalidate(path)
 
     def flush(self, path, fh):
+        if path in VIRTUAL_FILES:
+            return
         if not self.content_store.contains_file(path):
             self.content_store.create_local_file(path, os.O_CREAT | os.O_RDWR)
-        print "flushing %s" % (path)
         # return os.fsync(fh)
-        self.content_store.fsync(fh)
+        self.content_store.flush(fh)
 
     def release(self, path, fh):
         # return os.close(fh)
-        print "RELEASE AND CLOSE!"
-        handle = self.content_store.get_handle(fh)
-        return handle.close()
+        if path in VIRTUAL_FILES:
+            with self.snapshot_lock:
+                self.snapshots.pop(fh, None)
+            return
+        # Whatever the open handle was reporting is now on disk.
+        try:
+            return self.content_store.release(fh)
+        finally:
+            self.attr_cache.invalidate(path)
 
     def fsync(self, path, fdatasync, fh):
-        print "fsyncing"
-        return self.flush(path, fh)
+        if path in VIRTUAL_FILES:
+            return
+        self.content_store.fsync(fh)
+
+    def destroy(self, path):
+        self.content_store.close()
 
-def main(mountpoint, root):
+def main(mountpoint, root, threaded = False, attr_ttl = ATTR_TTL, **store_options):
     # The file system is rooted at $(root), where they are modified and whatnot
     # The files in the directory can be used from the mount point
-    FUSE(FileSystemFacade(root), mountpoint, nothreads=True, foreground=True)
+    FUSE(FileSystemFacade(root, attr_ttl, **store_options), mountpoint, nothreads=not threaded, foreground=True,
+        entry_timeout=attr_ttl, attr_timeout=attr_ttl)
 
 if __name__ == '__main__':
-    main(sys.argv[2], sys.argv[1])
+    parser = argparse.ArgumentParser(prog='enfs', description='ENFS: an encrypted FUSE file system.')
+    parser.add_argument('root', help="The directory backing the file system.")
+    parser.add_argument('mount', help="The mount point.")
+    parser.add_argument('--cache-mb', action="store", type=int, default=DEFAULT_CACHE_BYTES // (1024 * 1024),
+        help="Page cache memory budget in MiB.")
+    parser.add_argument('-t', '--threaded', action="store_true", help="Serve FUSE requests from multiple threads.")
+    parser.add_argument('-e', '--encrypt', action="store_true",
+        help="Encrypt file contents; the passphrase is read from $ENFS_PASSPHRASE or prompted for.")
+    parser.add_argument('--crypto-workers', action="store", type=int, default=None,
+        help="Threads used to seal and open chunks (default: one per CPU).")
+    parser.add_argument('--writeback-delay', action="store", type=float, default=0,
+        help="Seconds a flushed file may stay dirty before it is written back; 0 writes through on every flush.")
+    parser.add_argument('--dirty-mb', action="store", type=int, default=DIRTY_LIMIT // (1024 * 1024),
+        help="Write back early once this many MiB are waiting.")
+    parser.add_argument('--attr-ttl', action="store", type=float, default=ATTR_TTL,
+        help="Seconds attributes and directory listings may be cached.")
+    parser.add_argument('--max-idle-files', action="store", type=int, default=MAX_IDLE_FILES,
+        help="Closed files whose metadata is kept in memory.")
+    parser.add_argument('--dedup', action="store_true",
+        help="Store file contents as content-addressed chunks shared between files.")
+    parser.add_argument('--mmap', action="store_true",
+        help="Serve unencrypted files from memory maps of their backing files instead of the page cache.")
+    parser.add_argument('--prefetch-workers', action="store", type=int, default=PREFETCH_WORKERS,
+        help="Threads reading ahead of sequential readers; 0 disables read-ahead.")
+    parser.add_argument('--wal', action="store_true",
+        help="Make fsync append to a write-ahead log under the root instead of syncing each file.")
+    parser.add_argument('--compress', action="store", choices=sorted(CODECS), default=None,
+        help="Compress each chunk of encrypted files before sealing it; chunks that do not compress are stored as is.")
+    parser.add_argument('--trace-level', action="store", choices=sorted(LEVELS, key=LEVELS.get), default="warn",
+        help="Log messages at or above this level to stderr.")
+    parser.add_argument('--trace-sample', action="store", type=float, default=1.0,
+        help="Fraction of log messages and traced operations to keep.")
+    parser.add_argument('--trace-ring', action="store", type=int, default=RING_SIZE,
+        help="Recent operations kept for %s; 0 disables the ring." % (TRACE_PATH))
+
+    args = parser.parse_args()
+    TRACER.configure(LEVELS[args.trace_level], args.trace_sample, args.trace_ring)
+
+    passphrase = None
+    if args.encrypt:
+        passphrase = os.environ.get("ENFS_PASSPHRASE") or getpass.getpass("Passphrase: ")
+
+    main(args.mount, args.root, args.threaded, args.attr_ttl,
+        cache_bytes = args.cache_mb * 1024 * 1024,
+        passphrase = passphrase,
+        crypto_workers = args.crypto_workers,
+        writeback_delay = args.writeback_delay,
+        dirty_limit = args.dirty_mb * 1024 * 1024,
+        dedup = args.dedup,
+        use_mmap = args.mmap,
+        prefetch_workers = args.prefetch_workers,
+        max_idle_files = args.max_idle_files,
+        wal = args.wal,
+        compression = args.compress)
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+''' On-disk format round trip: for each storage mode, writes a set of
+files through a ContentStore, closes it, opens the root again with a fresh
+store and checks that every file reads back with the same size and bytes.
+'''
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+from ContentStore import *
+
+MODES = [
+    ("plain", {}),
+    ("mmap", {"use_mmap": True}),
+    ("wal", {"wal": True}),
+    ("writeback", {"writeback_delay": 0.05}),
+    ("dedup", {"dedup": True}),
+    ("encrypted", {"passphrase": "roundtrip"}),
+    ("compressed", {"passphrase": "roundtrip", "compression": "zlib"}),
+]
+
+def write(data, offset):
+    def step(handle, expected):
+        handle.write(data, offset)
+        if offset > len(expected):
+            expected.extend("\0" * (offset - len(expected)))
+        expected[offset:offset + len(data)] = data
+    return step
+
+def truncate(length):
+    def step(handle, expected):
+        handle.truncate(length)
+        if length > len(expected):
+            expected.extend("\0" * (length - len(expected)))
+        del expected[length:]
+    return step
+
+def fsync(handle, expected):
+    handle.fsync()
+
+# Each case is a list of steps applied to a freshly created file. Runs of
+# zeros matter: they leave no chunk behind in the chunked formats, so only
+# the recorded size can bring them back.
+CASES = {
+    "zeros": [write("\0" * 4096, 0)],
+    "zero-chunk": [write("\0" * PAGE_SIZE, 0)],
+    "zero-tail": [write("x" * 100, 0), fsync, write("\0" * 4000, 100)],
+    "zero-append": [write("x" * (PAGE_SIZE + 10), 0), fsync, write("\0" * PAGE_SIZE, PAGE_SIZE + 10)],
+    "sparse": [write("y", 3 * PAGE_SIZE + 5)],
+    "extend": [write("z" * 10, 0), fsync, truncate(2 * PAGE_SIZE + 3)],
+    "shrink": [write(os.urandom(3 * PAGE_SIZE), 0), truncate(PAGE_SIZE + 7)],
+    "rewrite": [write(os.urandom(2 * PAGE_SIZE), 0), write("a" * PAGE_SIZE, 0), write("\0" * 10, 2 * PAGE_SIZE)],
+    "empty": [],
+}
+
+def check_mode(mode, options):
+    root = tempfile.mkdtemp(prefix="enfs-roundtrip-")
+    errors = []
+    try:
+        expected = {}
+        store = ContentStore(root, **options)
+        for case, steps in sorted(CASES.items()):
+            name = "/" + case
+            contents = bytearray()
+            fid = store.create(name, 0644)
+            handle = store.get_handle(fid)
+            for step in steps:
+                step(handle, contents)
+            store.release(fid)
+            expected[name] = str(contents)
+        store.close()
+
+        store = ContentStore(root, **options)
+        for name, contents in sorted(expected.items()):
+            size = store.file_size(name, os.path.getsize(store._full_path(name)))
+            fid = store.open(name, os.O_RDONLY)
+            data = store.get_handle(fid).read(0, len(contents) + PAGE_SIZE)
+            store.release(fid)
+            if size != len(contents):
+                errors.append("%s %s: size %d, expected %d" % (mode, name, size, len(contents)))
+            elif data != contents:
+                errors.append("%s %s: contents differ" % (mode, name))
+        store.close()
+    finally:
+        shutil.rmtree(root)
+    return errors
+
+def run(modes):
+    errors = []
+    for mode, options in MODES:
+        if not modes or mode in modes:
+            errors += check_mode(mode, options)
+    for error in errors:
+        print error
+    print "%d modes, %d files each: %d errors" % (len(modes or MODES), len(CASES), len(errors))
+    return len(errors) == 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='enfs-roundtrip', description='Check that every storage format reads back what was written.')
+    parser.add_argument('modes', nargs='*', help="Modes to check (default: all): %s." % (", ".join(mode for mode, options in MODES)))
+
+    args = parser.parse_args()
+
+    sys.exit(0 if run(args.modes) else 1)
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+''' Concurrency stress harness: mounts enfs in threaded mode on a temporary
+directory and hammers it with parallel readers and writers, checking that
+every byte read back is what was written.
+'''
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+
+def wait_for_mount(mountpoint, timeout = 10):
+    deadline = time.time() + timeout
+    while not os.path.ismount(mountpoint):
+        if time.time() > deadline:
+            raise Exception("%s was not mounted after %d seconds" % (mountpoint, timeout))
+        time.sleep(0.1)
+
+def pattern(seed, length):
+    ''' Deterministic, seed-dependent content so readers can verify data.
+    '''
+    blocks = []
+    counter = 0
+    while len(blocks) * 32 < length:
+        blocks.append(hashlib.sha256("%d-%d" % (seed, counter)).digest())
+        counter += 1
+    return "".join(blocks)[:length]
+
+def writer(mountpoint, seed, size, block, errors):
+    path = os.path.join(mountpoint, "writer-%d" % (seed))
+    expected = pattern(seed, size)
+    try:
+        with open(path, "w") as fh:
+            for offset in range(0, size, block):
+                fh.write(expected[offset:offset + block])
+        with open(path) as fh:
+            if fh.read() != expected:
+                errors.append("writer %d read back different contents" % (seed))
+    except Exception as e:
+        errors.append("writer %d: %s" % (seed, e))
+
+def reader(mountpoint, expected, block, rounds, errors):
+    path = os.path.join(mountpoint, "shared")
+    try:
+        for i in range(rounds):
+            with open(path) as fh:
+                for offset in range(0, len(expected), block):
+                    if fh.read(block) != expected[offset:offset + block]:
+                        errors.append("reader saw bad data at offset %d" % (offset))
+                        return
+    except Exception as e:
+        errors.append("reader: %s" % (e))
+
+def run(readers, writers, size, block, rounds):
+    root = tempfile.mkdtemp(prefix="enfs-root-")
+    mountpoint = tempfile.mkdtemp(prefix="enfs-mount-")
+    shared = pattern(-1, size)
+    with open(os.path.join(root, "shared"), "w") as fh:
+        fh.write(shared)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    fs = subprocess.Popen([sys.executable, os.path.join(here, "enfs.py"), root, mountpoint, "--threaded"],
+        stdout=open(os.devnull, "w"))
+    errors = []
+    try:
+        wait_for_mount(mountpoint)
+        threads = [threading.Thread(target=writer, args=(mountpoint, i, size, block, errors)) for i in range(writers)]
+        threads += [threading.Thread(target=reader, args=(mountpoint, shared, block, rounds, errors)) for i in range(readers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        subprocess.call(["fusermount", "-u", mountpoint])
+        fs.wait()
+        shutil.rmtree(root)
+        os.rmdir(mountpoint)
+
+    for error in errors:
+        print error
+    print "%d readers, %d writers, %d bytes each: %.2fs, %d errors" % (readers, writers, size, elapsed, len(errors))
+    return len(errors) == 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='enfs-stress', description='Run parallel readers and writers against a threaded enfs mount.')
+    parser.add_argument('-r', '--readers', action="store", type=int, default=8, help="Number of reader threads.")
+    parser.add_argument('-w', '--writers', action="store", type=int, default=8, help="Number of writer threads.")
+    parser.add_argument('-s', '--size', action="store", type=int, default=4 * 1024 * 1024, help="Bytes per file.")
+    parser.add_argument('-b', '--block', action="store", type=int, default=64 * 1024, help="I/O size in bytes.")
+    parser.add_argument('-n', '--rounds', action="store", type=int, default=4, help="Passes over the shared file per reader.")
+
+    args = parser.parse_args()
+
+    sys.exit(0 if run(args.readers, args.writers, args.size, args.block, args.rounds) else 1)
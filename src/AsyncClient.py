@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import time
+import heapq
+import Queue
+import threading
+
+from Messages import *
+from SegmentFetcher import *
+from RemoteCache import DEFAULT_EXPIRY
+
+REQUEST_TIMEOUT = 4.0
+READ_INTERVAL = 0.05
+
+class RequestTimeout(Exception):
+    pass
+
+class Future(object):
+    ''' The eventual result of one request.
+    '''
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.event.is_set()
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_exception(self, error):
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout = None):
+        if not self.event.wait(timeout):
+            raise RequestTimeout("result not ready")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class AsyncClient(object):
+    ''' Many concurrent requests multiplexed over one portal.
+
+    A single reader thread owns receive_content() on the transport and hands
+    each ContentObject to every pending request for its name; requests for a
+    name that is already outstanding share its Interest. Each request has
+    its own deadline, after which its future fails with RequestTimeout; once
+    nobody waits for a name any more, its Interest is cancelled.
+
+    The transport is anything with send_interest(interest),
+    cancel_interest(name) and receive_content(timeout): a CCNxClient with an
+    async portal, a LoopbackPortal, or a face on a FakeForwarder.
+    '''
+    def __init__(self, transport):
+        self.transport = transport
+        self.pending = {} # name -> list of futures
+        self.deadlines = [] # heap of (deadline, seq, name, future)
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.running = True
+        self.reader = threading.Thread(target=self.read_loop, name="ccnx-reader")
+        self.reader.daemon = True
+        self.reader.start()
+
+    def get_async(self, name, data = None, timeout = REQUEST_TIMEOUT, resend = False):
+        ''' Send an Interest for `name` (unless one is already outstanding
+        and not `resend`) and return a Future for the payload of the answer.
+        '''
+        interest = Interest(Name(name))
+        if data != None:
+            interest.setPayload(data)
+        # Keyed the way answers will name themselves.
+        name = str(interest.name)
+        future = Future()
+        with self.lock:
+            waiters = self.pending.get(name)
+            first = waiters is None
+            if first:
+                waiters = self.pending[name] = []
+            waiters.append(future)
+            self.seq += 1
+            heapq.heappush(self.deadlines, (time.time() + timeout, self.seq, name, future))
+        if first or resend:
+            with self.send_lock:
+                self.transport.send_interest(interest)
+        return future
+
+    def get(self, name, data = None, timeout = REQUEST_TIMEOUT):
+        ''' Blocking form of get_async(); returns None on timeout.
+        '''
+        try:
+            return self.get_async(name, data, timeout).result()
+        except RequestTimeout:
+            return None
+
+    def volatile_get(self, name, data = None):
+        ''' Return (payload, seconds until the payload expires), like
+        CCNxClient.volatile_get, with None for a request that timed out.
+        '''
+        return self.get(name, data), DEFAULT_EXPIRY
+
+    def fetch(self, name, count = None, digests = None, timeout = REQUEST_TIMEOUT, **window_options):
+        ''' Fetch a segmented object with a window of Interests in flight,
+        sharing the portal with every other request.
+        '''
+        return WindowedFetcher(Channel(self, timeout), **window_options).fetch(name, count, digests)
+
+    def get_many(self, names, timeout = REQUEST_TIMEOUT):
+        ''' Issue every request at once and return the payloads in order,
+        with None for any that timed out.
+        '''
+        futures = [self.get_async(name, timeout = timeout) for name in names]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except RequestTimeout:
+                results.append(None)
+        return results
+
+    def expire(self, now):
+        expired = []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, seq, name, future = heapq.heappop(self.deadlines)
+                waiters = self.pending.get(name)
+                if waiters is None or future not in waiters:
+                    continue # already answered
+                waiters.remove(future)
+                if not waiters:
+                    del self.pending[name]
+                expired.append((name, future, not waiters))
+        for name, future, abandoned in expired:
+            if abandoned:
+                with self.send_lock:
+                    self.transport.cancel_interest(name)
+            future.set_exception(RequestTimeout("no answer for %s" % (name)))
+
+    def read_loop(self):
+        while self.running:
+            response = self.transport.receive_content(READ_INTERVAL)
+            if response is not None:
+                with self.lock:
+                    waiters = self.pending.pop(str(response.name), [])
+                payload = response.getPayload()
+                for future in waiters:
+                    future.set_result(payload)
+            self.expire(time.time())
+
+    def close(self):
+        self.running = False
+        self.reader.join()
+        self.expire(float("inf"))
+
+class Channel(object):
+    ''' One fetch's transport over an AsyncClient, for a WindowedFetcher.
+
+    Interests go out through the multiplexer, a retransmission as a fresh
+    Interest, and answers are queued for receive_content(); the reader
+    thread stays the only one receiving from the portal.
+    '''
+    def __init__(self, client, timeout = REQUEST_TIMEOUT):
+        self.client = client
+        self.timeout = timeout
+        self.answers = Queue.Queue()
+
+    def send_interest(self, interest):
+        name = str(interest.name)
+        future = self.client.get_async(name, timeout = self.timeout, resend = True)
+        future.add_done_callback(lambda future: self.answered(name, future))
+
+    def answered(self, name, future):
+        if future.error is None:
+            self.answers.put(ContentObject(Name(name), future.value))
+
+    def receive_content(self, timeout):
+        try:
+            return self.answers.get(True, max(0, timeout))
+        except Queue.Empty:
+            return None
@@ -10,15 +10,24 @@ import time
 import tempfile
 import json
 import stat
+import threading
 
 sys.path.append('/Users/cwood/PARC/Distillery/build/lib/python2.7/site-packages')
 from CCNx import *
+from SegmentFetcher import *
+from RemoteCache import DEFAULT_EXPIRY
+from common.Trace import TRACER
+
+POLL_INTERVAL = 0.001
 
 class CCNxClient(object):
     def __init__(self, async = False):
-        print "Async? %d" % (async)
         self.portal = self.openAsyncPortal() if async else self.openPortal()
-        print "Done."
+        # get() and get_async() each own the portal from send to receive, so
+        # an answer can only reach the request it is for. Use AsyncClient to
+        # have many requests in flight at once.
+        self.lock = threading.Lock()
+        TRACER.debug("opened %s portal", "an async" if async else "a")
 
     def setupIdentity(self):
         global IDENTITY_FILE
@@ -44,13 +53,22 @@ class CCNxClient(object):
         if data != None:
             interest.setPayload(data)
 
-        self.portal.send(interest)
-        response = self.portal.receive()
+        with self.lock:
+            self.portal.send(interest)
+            while True:
+                response = self.portal.receive()
+                if not isinstance(response, ContentObject):
+                    return None
+                if str(response.name) == str(interest.name):
+                    return response.getPayload()
+                # A late answer to an earlier request that gave up.
+                TRACER.debug("dropping unexpected content %s", response.name)
 
-        if isinstance(response, ContentObject):
-            return response.getPayload()
-        else:
-            return None
+    def volatile_get(self, name, data = None):
+        ''' Return (payload, seconds until the payload expires). The portal
+        does not report a freshness period, so DEFAULT_EXPIRY is assumed.
+        '''
+        return self.get(name, data), DEFAULT_EXPIRY
 
     def get_async(self, name, data, timeout_seconds):
         interest = None
@@ -61,9 +79,10 @@ class CCNxClient(object):
 
         for i in range(timeout_seconds):
             try:
-                self.portal.send(interest)
-                response = self.portal.receive()
-                if response and isinstance(response, ContentObject):
+                with self.lock:
+                    self.portal.send(interest)
+                    response = self.portal.receive()
+                if response and isinstance(response, ContentObject) and str(response.name) == str(interest.name):
                     return response.getPayload()
             except Portal.CommunicationsError as x:
                 if x.errno == errno.EAGAIN:
@@ -72,19 +91,53 @@ class CCNxClient(object):
                     raise
         return None
 
+    def send_interest(self, interest):
+        self.portal.send(interest)
+
+    def cancel_interest(self, name):
+        ''' The portal cannot withdraw an Interest; the forwarder drops it
+        when its lifetime runs out.
+        '''
+        pass
+
+    def receive_content(self, timeout):
+        ''' Wait up to `timeout` seconds for a ContentObject. This needs a
+        non-blocking (async) portal; a blocking one waits indefinitely.
+        '''
+        deadline = time.time() + timeout
+        while True:
+            try:
+                response = self.portal.receive()
+                if isinstance(response, ContentObject):
+                    return response
+            except Portal.CommunicationsError as x:
+                if x.errno != errno.EAGAIN:
+                    raise
+                if time.time() >= deadline:
+                    return None
+                time.sleep(POLL_INTERVAL)
+
+    def fetch(self, name, count = None, **window_options):
+        ''' Fetch a segmented object with a window of Interests in flight.
+        This owns the portal for the whole fetch, so it must not be used on
+        a client an AsyncClient reads from; use AsyncClient.fetch there.
+        '''
+        with self.lock:
+            return WindowedFetcher(self, **window_options).fetch(name, count)
+
     def push(self, name, data):
         interest = Interest(Name(name), payload=data)
         try:
             self.portal.send(interest)
         except Portal.CommunicationsError as x:
-            sys.stderr.write("ccnxPortal_Write failed: %d\n" % (x.errno,))
+            TRACER.error("ccnxPortal_Write failed: %d", x.errno)
         pass
 
     def listen(self, prefix):
         try:
             self.portal.listen(Name(prefix))
         except Portal.CommunicationsError as x:
-            sys.stderr.write("CCNxClient: comm error attempting to listen: %s\n" % (x.errno,))
+            TRACER.error("CCNxClient: comm error attempting to listen: %s", x.errno)
         return True
 
     def receive(self):
@@ -107,7 +160,7 @@ class CCNxClient(object):
         try:
             self.portal.send(ContentObject(Name(name), data))
         except Portal.CommunicationsError as x:
-            sys.stderr.write("reply failed: %d\n" % (x.errno,))
+            TRACER.error("reply failed: %d", x.errno)
 
 if __name__ == "__main__":
     client = CCNxClient()
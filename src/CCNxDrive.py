@@ -12,70 +12,115 @@ import time
 import tempfile
 import json
 import stat
+import threading
 
 from CCNxClient import *
 from ContentStore import *
 from FileHandle import *
+from common.Trace import *
 from fuse import FUSE, FuseOSError, Operations
 
-def display_args(func):
-    argnames = func.func_code.co_varnames[:func.func_code.co_argcount]
-    fname = func.func_name
-    def echo_func(*args,**kwargs):
-        print fname, "(", ', '.join(
-            '%s=%r' % entry
-            for entry in zip(argnames,args[:len(argnames)]) + [("args",list(args[len(argnames):]))] + [("kwargs",kwargs)]) + " )"
-        print >> sys.stdout, fname, "(", ', '.join(
-            '%s=%r' % entry
-            for entry in zip(argnames,args[:len(argnames)]) + [("args",list(args[len(argnames):]))] + [("kwargs",kwargs)]) + " )"
-    return func
+# A read-only virtual file with the drive's metrics as JSON.
+STATS_PATH = "/.stats"
+STATS_BLOCK = 4096
+# A read-only virtual file with the most recent operations from the trace ring.
+TRACE_PATH = "/.trace"
+VIRTUAL_FILES = (STATS_PATH, TRACE_PATH)
+# Descriptors of open virtual files start here, far above the store's own.
+VIRTUAL_FH_BASE = 1 << 32
 
 class CCNxDrive(Operations):
-    @display_args
-    def __init__(self, root):
+    def __init__(self, root, disk_cache_bytes = DEFAULT_DISK_CACHE_BYTES):
         self.root = root
-        self.content_store = ContentStore(root)
+        self.content_store = ContentStore(root, disk_cache_bytes = disk_cache_bytes)
+        self.metrics = self.content_store.metrics
+        # The contents of every open virtual file, by descriptor: open()
+        # takes one snapshot and every read and fgetattr is served from it.
+        self.snapshots = {}
+        self.snapshot_seq = VIRTUAL_FH_BASE
+        self.snapshot_lock = threading.Lock()
+
+    def __call__(self, op, *args):
+        if TRACER.enabled(DEBUG):
+            TRACER.emit("%s(%s)" % (op, display_args(args)))
+        start = time.time()
+        try:
+            return super(CCNxDrive, self).__call__(op, *args)
+        except OSError as e:
+            self.metrics.count("errors." + op)
+            TRACER.info("%s %s failed: %s", op, args[0] if args else "", e)
+            raise
+        finally:
+            elapsed = time.time() - start
+            self.metrics.record("op." + op, elapsed)
+            if TRACER.ring_size and args and isinstance(args[0], str) and args[0] not in VIRTUAL_FILES:
+                offset, length = extent_of(op, args)
+                TRACER.record(op, args[0], offset, length, elapsed)
+
+    def virtual_file(self, path):
+        ''' The contents of a virtual file, padded with blanks to a whole
+        block so its size changes rarely between getattr and read.
+        '''
+        data = self.stats() if path == STATS_PATH else TRACER.dump_text()
+        size = (len(data) // STATS_BLOCK + 1) * STATS_BLOCK
+        return data + " " * (size - len(data) - 1) + "\n"
+
+    def open_virtual(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise FuseOSError(errno.EACCES)
+        data = self.virtual_file(path)
+        with self.snapshot_lock:
+            fh = self.snapshot_seq
+            self.snapshot_seq += 1
+            self.snapshots[fh] = data
+        return fh
+
+    def snapshot(self, path, fh):
+        ''' The contents virtual file descriptor `fh` serves, or a fresh copy
+        for a request that names no descriptor.
+        '''
+        data = self.snapshots.get(fh) if fh is not None else None
+        return data if data is not None else self.virtual_file(path)
+
+    def stats(self):
+        return self.metrics.to_json()
 
-    @display_args
     def access(self, path, mode):
         ''' Return True if access is allowed, and False otherwise.
         '''
         return self.content_store.access(path)
 
-    @display_args
     def chmod(self, path, mode):
         ''' ???
         '''
         return self.content_store.chmod(path, mode)
 
-    @display_args
     def chown(self, path, uid, gid):
         ''' ???
         '''
         return self.content_store.chown(path, uid, gid)
 
-    @display_args
     def getattr(self, path, fh=None):
+        if path in VIRTUAL_FILES:
+            now = time.time()
+            return {'st_mode': stat.S_IFREG | 0444, 'st_nlink': 1, 'st_size': len(self.snapshot(path, fh)),
+                    'st_uid': os.getuid(), 'st_gid': os.getgid(), 'st_atime': now, 'st_mtime': now, 'st_ctime': now}
         return {}
 
-    @display_args
     def readdir(self, path, fh):
-        return self.content_store.read_namespace(path)
+        return ['.', '..'] + self.content_store.read_namespace(path)
 
-    @display_args
     def readlink(self, path):
         ''' Return a string representing the path to which the symbolic link points.
         Names are names in CCN, so we just return the path.
         '''
         return path
 
-    @display_args
     def mknod(self, path, mode, dev):
         # return os.mknod(self._full_path(path), mode, dev)
         # TODO: is this the same as a Manifest?
         raise Exception()
 
-    @display_args
     def rmdir(self, path):
         return self.content_store.delete_namespace(path)
 
@@ -84,7 +129,6 @@ class CCNxDrive(Operations):
         # TODO: is this the same as a Manifest?
         raise Exception()
 
-    @display_args
     def statfs(self, path):
         stv = os.statvfs(path)
         return dict((key, getattr(stv, key)) for key in ('f_bavail', 'f_bfree',
@@ -92,71 +136,73 @@ class CCNxDrive(Operations):
             'f_frsize', 'f_namemax'))
         # raise Exception("statfs not implemented.")
 
-    @display_args
     def unlink(self, path):
         self.content_store.unlink(path)
 
-    @display_args
     def symlink(self, name, target):
         self.content_store.symlink(name, target)
 
-    @display_args
     def rename(self, old, new):
         # TODO: do it
         pass
         # raise Exception("rename not implemented")
 
-    @display_args
     def link(self, target, name):
         # TODO: do it
         return os.link(target, name)
         # raise Exception("link not implemented")
 
-    @display_args
     def utimens(self, path, times=None):
         self.content_store.utime(path, times)
 
-    @display_args
     def open(self, path, flags):
+        if path in VIRTUAL_FILES:
+            return self.open_virtual(path, flags)
         return self.content_store.open(path, flags)
 
-    @display_args
     def create(self, path, mode, fi=None):
         return self.content_store.create_local_file(path, mode).fid
 
-    @display_args
     def read(self, path, length, offset, fh = None):
+        if path in VIRTUAL_FILES:
+            return self.snapshot(path, fh)[offset:offset + length]
         handle = self.content_store.get_handle_from_path(path)
-        return handle.read(length, offset)
+        data = handle.read(offset, length)
+        self.metrics.count("bytes.read", len(data or ""))
+        return data
 
-    @display_args
     def write(self, path, buffer, offset, fh = None):
         handle = self.content_store.get_handle_from_path(path)
+        self.metrics.count("bytes.written", len(buffer))
         return handle.write(buffer, offset)
 
-    @display_args
     def truncate(self, path, length, fh = None):
         handle = self.content_store.get_handle_from_path(path)
         return handle.truncate(length)
 
-    @display_args
     def flush(self, path, fh):
+        if path in VIRTUAL_FILES:
+            return
         handle = self.content_store.get_handle_from_path(path)
-        return handle.fsync(length)
+        return handle.fsync()
 
-    @display_args
     def release(self, path, fh):
+        if path in VIRTUAL_FILES:
+            with self.snapshot_lock:
+                self.snapshots.pop(fh, None)
+            return
         handle = self.content_store.get_handle_from_path(path)
-        return handle.close(length)
+        return handle.close()
 
-    @display_args
     def fsync(self, path, fdatasync, fh):
         return self.flush(path, fh)
 
-@display_args
-def main(mountpoint, root):
-    drive = CCNxDrive(root)
-    FUSE(drive, mountpoint, nothreads=True, foreground=True) # run until done.
+    def destroy(self, path):
+        self.content_store.close()
+
+def main(mountpoint, root, threaded = False, disk_cache_bytes = DEFAULT_DISK_CACHE_BYTES):
+    drive = CCNxDrive(root, disk_cache_bytes)
+    FUSE(drive, mountpoint, nothreads=not threaded, foreground=True) # run until done.
 
 if __name__ == '__main__':
     desc = '''CCN-FUSE: The FUSE adapter for CCN.
@@ -165,7 +211,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='ccn-fuse', formatter_class=argparse.RawDescriptionHelpFormatter, description=desc)
     parser.add_argument('-m', '--mount', action="store", required=True, help="The CCN-FUSE moint point.")
     parser.add_argument('-r', '--root', action="store", required=True, help="The root of the CCN-FUSE file system.")
+    parser.add_argument('-t', '--threaded', action="store_true", help="Serve FUSE requests from multiple threads.")
+    parser.add_argument('--disk-cache-mb', action="store", type=int, default=DEFAULT_DISK_CACHE_BYTES // (1024 * 1024), help="Size cap of the on-disk cache of fetched content, in MiB.")
+    parser.add_argument('--trace-level', action="store", choices=sorted(LEVELS, key=LEVELS.get), default="warn", help="Log messages at or above this level to stderr.")
+    parser.add_argument('--trace-sample', action="store", type=float, default=1.0, help="Fraction of log messages and traced operations to keep.")
+    parser.add_argument('--trace-ring', action="store", type=int, default=RING_SIZE, help="Recent operations kept for %s; 0 disables the ring." % (TRACE_PATH))
 
     args = parser.parse_args()
+    TRACER.configure(LEVELS[args.trace_level], args.trace_sample, args.trace_ring)
 
-    main(args.mount, args.root)
+    main(args.mount, args.root, args.threaded, args.disk_cache_mb * 1024 * 1024)
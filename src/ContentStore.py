@@ -10,99 +10,188 @@ import time
 import tempfile
 import json
 import stat
+import threading
 
 from FileHandle import *
 from CCNxClient import *
+from AsyncClient import *
+from Publisher import *
+from common.NameTrie import *
+from RemoteCache import *
+from DiskCache import *
+from common.Metrics import *
+from common.MetaJournal import *
+from common.Trace import *
+
+# Attributes set on remote files are journaled here, under the root.
+JOURNAL_DIR = ".ccnx-meta"
 
 class ContentStore(object):
-    def __init__(self, root):
+    def __init__(self, root, remote_cache_bytes = DEFAULT_REMOTE_CACHE_BYTES, disk_cache_bytes = DEFAULT_DISK_CACHE_BYTES):
         self.root = root
-        self.files = {}
+        self.files = NameTrie()
         self.handles = {}
         self.descriptor_seq = 0
-        self.client = CCNxClient()
+        # Remote reads from every FUSE thread and the cache's refresh worker
+        # share one async portal; the multiplexer matches answers to requests.
+        self.client = CCNxClient(async = True)
+        self.requests = AsyncClient(self.client)
+        self.disk_cache = DiskCache(os.path.join(root, CACHE_DIR), disk_cache_bytes)
+        self.metrics = Metrics()
+        self.journal = MetaJournal(os.path.join(root, JOURNAL_DIR), thread_name = "ccnx-journal")
+        self.remote_cache = RemoteCache(self.fetch_remote, remote_cache_bytes, self.disk_cache, self.metrics)
+        self.metrics.gauge("remote_cache_bytes", lambda: self.remote_cache.used)
+        self.metrics.gauge("disk_cache_bytes", lambda: self.disk_cache.used)
+        # Guards the namespace (files, handles, descriptor_seq); per-file
+        # data is protected by each FileHandle's own reader/writer lock.
+        self.lock = threading.RLock()
+
+    def fetch_remote(self, name):
+        ''' Fetch a remote object for the RemoteCache. A file published in
+        segments is pulled with a window of Interests in flight, checked
+        against its manifest; anything else comes back whole for a single
+        Interest. Both are asked for at once and the first answer decides.
+        '''
+        answered = threading.Event()
+        whole = self.requests.get_async(name)
+        probe = self.requests.get_async(segment_name(manifest_name(name), 0))
+        for future in (whole, probe):
+            future.add_done_callback(lambda future: answered.set())
+        while True:
+            answered.wait()
+            answered.clear()
+            if whole.done() and whole.error is None:
+                return whole.value, DEFAULT_EXPIRY
+            if probe.done() and probe.error is None:
+                break
+            if whole.done() and probe.done():
+                return None, DEFAULT_EXPIRY
+        try:
+            channel = Channel(self.requests)
+            return fetch_segments(channel, name, fetch_manifest(channel, name)), DEFAULT_EXPIRY
+        except (FetchTimeout, ValueError) as e:
+            TRACER.warn("fetch of %s failed: %s", name, e)
+            return None, DEFAULT_EXPIRY
 
     def contains_file(self, name):
-        return name in self.files
+        with self.lock:
+            return name in self.files
 
     def load(self, name):
-        return self.files[name].load()
+        return self.get_handle_from_path(name).load()
 
     def open(self, name, flags):
-        if self.contains_file(name):
-            self.files[name].flags = flags
-            return self.load(name).fid
-        else:
-            return self.create_remote_file(name).load().fid
+        with self.lock:
+            if name in self.files:
+                handle = self.files[name]
+                handle.flags = flags
+            else:
+                handle = self.create_remote_file(name)
+        return handle.load().fid
 
     def get_handle_from_path(self, path):
-        if path in self.files:
-            return self.files[path]
-        else:
-            raise Exception("File %s does not exist" % (path))
+        with self.lock:
+            if path in self.files:
+                return self.files[path]
+        raise Exception("File %s does not exist" % (path))
 
     def get_handle(self, fh):
-        if fh in self.handles:
-            return self.handles[fh]
-        else:
-            raise Exception("File handle %d does not exist" % (fh))
+        with self.lock:
+            if fh in self.handles:
+                return self.handles[fh]
+        raise Exception("File handle %d does not exist" % (fh))
 
     def create_local_file(self, name, mode):
-        if name not in self.files:
-            self.files[name] = LocalFileHandle(name, os.path.join(self.root, name), mode, descriptor_seq)
-            self.handles[descriptor_seq] = self.files[name]
-            descriptor_seq += 1
-        return self.files[name]
-
-    def create_remote_file(self, name, mode):
-        if name not in self.files:
-            self.files[name] = RemoteFileHandle(name, os.path.join(self.root, name), descriptor_seq, self.client)
-            self.handles[descriptor_seq] = self.files[name]
-            descriptor_seq += 1
-        return self.files[name]
-
-    def get_files_in_namespace(files, prefix):
-        fileset = []
-        for fhandle in self.files:
-            if fhandle.name.startswith(prefix):
-                fileset.append(fhandle.name)
-        return fileset
+        with self.lock:
+            if name not in self.files:
+                self.files[name] = LocalFileHandle(name, os.path.join(self.root, name), mode, self.descriptor_seq)
+                self.restore_attributes(self.files[name])
+                self.handles[self.descriptor_seq] = self.files[name]
+                self.descriptor_seq += 1
+            return self.files[name]
+
+    def create_remote_file(self, name):
+        with self.lock:
+            if name not in self.files:
+                self.files[name] = RemoteFileHandle(name, os.path.join(self.root, name), self.descriptor_seq, self.remote_cache)
+                self.restore_attributes(self.files[name])
+                self.handles[self.descriptor_seq] = self.files[name]
+                self.descriptor_seq += 1
+            return self.files[name]
+
+    def restore_attributes(self, handle):
+        attrs = self.journal.get(handle.name)
+        if attrs is None:
+            return
+        handle.mode = attrs.get("mode", handle.mode)
+        handle.uid = attrs.get("uid", handle.uid)
+        handle.gid = attrs.get("gid", handle.gid)
+        if "mtime" in attrs:
+            handle.times = (attrs["atime"], attrs["mtime"])
+
+    def close(self):
+        self.remote_cache.close()
+        self.requests.close()
+        self.disk_cache.close()
+        self.journal.stop()
+
+    def get_files_in_namespace(self, prefix):
+        with self.lock:
+            return [name for name, fhandle in self.files.items(prefix)]
 
     def read_namespace(self, prefix):
-        return get_files_in_namespace(self.files, prefix)
+        ''' Return the names immediately below `prefix`.
+        '''
+        with self.lock:
+            return self.files.children(prefix)
 
     def delete_namespace(self, prefix):
-        fileset = get_files_in_namespace(self.files, prefix)
-        for fhandle in fileset:
+        with self.lock:
+            fileset = self.files.pop_prefix(prefix)
+        self.journal.remove(prefix)
+        for name, fhandle in fileset:
             fhandle.unload()
-            self.files.pop(fhandle.name, None)
 
     def access(self, name):
-        return self.files[name].access()
+        return self.get_handle_from_path(name).access()
 
     def chmod(self, name, mode):
-        self.files[name].mode = mode
+        self.get_handle_from_path(name).mode = mode
+        self.journal.update(name, mode = mode)
         return mode
 
     def chown(self, name, uid, gid):
-        self.files[name].uid = uid
-        self.files[name].uid = gid
+        ''' Record a new owner; -1 leaves the uid or gid unchanged.
+        '''
+        handle = self.get_handle_from_path(name)
+        attrs = {}
+        if uid != -1:
+            attrs["uid"] = handle.uid = uid
+        if gid != -1:
+            attrs["gid"] = handle.gid = gid
+        self.journal.update(name, **attrs)
         return True
 
     def symlink(self, name, target):
-        if name not in self.files:
-            raise Exception("%s not a valid file" % (name))
-        if target in self.files:
-            return
-        self.files[target] = self.files[name]
+        with self.lock:
+            if name not in self.files:
+                raise Exception("%s not a valid file" % (name))
+            if target in self.files:
+                return
+            self.files[target] = self.files[name]
 
     def unlink(self, name):
-        if name not in self.files:
-            raise Exception("%s not a valid file" % (name))
-        self.files[name].close()
-        del self.files[name]
+        with self.lock:
+            if name not in self.files:
+                raise Exception("%s not a valid file" % (name))
+            handle = self.files.pop(name)
+        self.journal.remove(name)
+        handle.close()
 
     def utime(self, name, times):
-        if name not in self.files:
-            raise Exception("%s not a valid file" % (name))
-        self.files[name].times = times
+        with self.lock:
+            if name not in self.files:
+                raise Exception("%s not a valid file" % (name))
+            times = tuple(times or (time.time(), time.time()))
+            self.files[name].times = times
+        self.journal.update(name, atime = times[0], mtime = times[1])
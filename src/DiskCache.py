@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from common.Files import write_atomically
+from common.Trace import *
+
+CACHE_DIR = ".ccnx-cache"
+DEFAULT_DISK_CACHE_BYTES = 1024 * 1024 * 1024
+MAINTENANCE_INTERVAL = 5.0
+
+class DiskCache(object):
+    ''' Fetched remote objects kept on local disk across mounts.
+
+    Payloads are stored once per SHA-256 digest under blobs/, and the index
+    maps each name to [digest, expiry (wall clock), size, last use]. The
+    index is rewritten by a background thread every MAINTENANCE_INTERVAL
+    seconds when it changed; the same thread evicts the least recently used
+    names once the blobs exceed `cap` bytes.
+    '''
+    def __init__(self, directory, cap = DEFAULT_DISK_CACHE_BYTES, interval = MAINTENANCE_INTERVAL):
+        self.directory = directory
+        self.cap = cap
+        self.interval = interval
+        self.index_path = os.path.join(directory, "index")
+        self.index = {}
+        self.refs = {} # digest -> number of names using it
+        self.sizes = {} # digest -> blob size
+        self.used = 0
+        self.changed = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        if not os.path.isdir(os.path.join(directory, "blobs")):
+            os.makedirs(os.path.join(directory, "blobs"))
+        self.reload()
+        self.worker = threading.Thread(target=self.maintain, name="disk-cache")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, "blobs", digest[:2], digest)
+
+    def reload(self):
+        ''' Read the index, keeping only names whose blob is still there.
+        '''
+        try:
+            with open(self.index_path, "rb") as fh:
+                stored = json.load(fh)
+        except (IOError, ValueError):
+            stored = {}
+        for name, entry in stored.items():
+            digest, expires, size, last_used = entry
+            try:
+                name = name.encode("latin-1")
+            except UnicodeEncodeError:
+                # Only an index written as UTF-8 holds such names.
+                self.changed = True
+                continue
+            if digest not in self.refs:
+                if not os.path.exists(self.blob_path(digest)):
+                    self.changed = True
+                    continue
+                self.refs[digest] = 0
+                self.sizes[digest] = size
+                self.used += size
+            self.refs[digest] += 1
+            self.index[name] = entry
+
+    def get(self, name):
+        ''' Return (payload, expiry) for `name`, or None.
+        '''
+        with self.lock:
+            entry = self.index.get(name)
+            if entry is None:
+                return None
+            entry[3] = time.time()
+            self.changed = True
+            digest, expires = entry[0], entry[1]
+        try:
+            with open(self.blob_path(digest), "rb") as fh:
+                payload = fh.read()
+        except IOError:
+            self.remove(name)
+            return None
+        if hashlib.sha256(payload).hexdigest() != digest:
+            self.remove(name)
+            return None
+        return payload, expires
+
+    def put(self, name, payload, expires):
+        digest = hashlib.sha256(payload).hexdigest()
+        path = self.blob_path(digest)
+        # Hold a reference to the blob while it is written, so neither the
+        # entry being replaced (which may well be the same blob) nor any
+        # other name sharing it can unlink it underneath.
+        with self.lock:
+            if digest not in self.refs:
+                self.refs[digest] = 0
+                self.sizes[digest] = len(payload)
+                self.used += len(payload)
+            self.refs[digest] += 1
+        try:
+            if not os.path.exists(path):
+                if not os.path.isdir(os.path.dirname(path)):
+                    try:
+                        os.makedirs(os.path.dirname(path))
+                    except OSError:
+                        pass # created concurrently
+                write_atomically(path, payload)
+        except Exception:
+            with self.lock:
+                self._release(digest)
+            raise
+        with self.lock:
+            self._remove(name)
+            self.index[name] = [digest, expires, len(payload), time.time()]
+            self.changed = True
+
+    def remove(self, name):
+        with self.lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        entry = self.index.pop(name, None)
+        if entry is None:
+            return
+        self.changed = True
+        self._release(entry[0])
+
+    def _release(self, digest):
+        self.refs[digest] -= 1
+        if self.refs[digest] == 0:
+            del self.refs[digest]
+            self.used -= self.sizes.pop(digest)
+            try:
+                os.unlink(self.blob_path(digest))
+            except OSError:
+                pass
+
+    def evict(self):
+        with self.lock:
+            if self.used <= self.cap:
+                return
+            for name, entry in sorted(self.index.items(), key=lambda item: item[1][3]):
+                if self.used <= self.cap:
+                    break
+                self._remove(name)
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            # Names are arbitrary bytes: store each as the code points of its
+            # bytes (latin-1), as MetaJournal does.
+            data = json.dumps(self.index, separators=(",", ":"), encoding="latin-1")
+            self.changed = False
+        write_atomically(self.index_path, data)
+
+    def maintain(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.evict()
+                self.save()
+            except Exception as e:
+                TRACER.error("disk cache maintenance failed: %s", e)
+
+    def close(self):
+        self.stopped.set()
+        self.worker.join()
+        self.evict()
+        self.save()
@@ -3,7 +3,7 @@
 # -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
 
 from CCNxClient import *
-from threading import Timer
+from common.Locks import *
 
 class FileHandle(object):
     def __init__(self, name, fullpath, mode, fid):
@@ -14,70 +14,96 @@ class FileHandle(object):
         self.offset = 0
         self.size = 0
         self.access = False
-        self.mode = stat.S_READ
+        self.mode = stat.S_IREAD
         self.uid = 0
         self.gid = 0
         self.times = (0, 0)
         self.flags = os.O_RDONLY # default
+        self.lock = RWLock()
 
     def load(self):
         pass
 
     def unload(self):
-        self.data = None
+        with self.lock.writing():
+            self.data = None
 
-    def read(self):
-        max_offset = max(self.size - 1, offset + length)
-        if offset >= self.size:
-            return None
-        else:
-            return self.data[offset:max_offset]
+    def read(self, offset, length):
+        with self.lock.reading():
+            max_offset = max(self.size - 1, offset + length)
+            if offset >= self.size:
+                return None
+            else:
+                return self.data[offset:max_offset]
 
     def write(self, buff, offset):
-        length = len(buff) + offset
-        if length > self.size:
-            self.size = length
-        self.data[offset:length] = buff
+        with self.lock.writing():
+            length = len(buff) + offset
+            if length > self.size:
+                self.size = length
+            self.data[offset:length] = buff
 
     def truncate(self, length):
         ''' Truncate the file to specified length.
         '''
-        self.size = length
+        with self.lock.writing():
+            self.size = length
 
     def fsync(self):
         ''' Force a write to the file system.
         '''
-        if self.data != None:
-            with open(self.fullpath, "w") as fhandle:
-                fhandle.write(self.data)
+        with self.lock.reading():
+            if self.data != None:
+                with open(self.fullpath, "w") as fhandle:
+                    fhandle.write(self.data)
 
     def close(self):
         ''' Unload and release all resources.
         '''
         self.unload()
-        self.data = None
 
 class LocalFileHandle(FileHandle):
     def __init__(self, name, fullpath, mode, fid):
         super(LocalFileHandle, self).__init__(name, fullpath, mode, fid)
 
     def load(self):
-        with open(self.name) as fhandle:
-            self.data = fhandle.read()
-            self.size = len(data)
+        with self.lock.writing():
+            with open(self.name) as fhandle:
+                self.data = fhandle.read()
+                self.size = len(self.data)
         return self
 
 class RemoteFileHandle(FileHandle):
-    def __init__(self, name, fullpath, fid, client):
-        super(LocalFileHandle, self).__init__(name, fullpath, 0, fid)
-        self.client = client
+    ''' A file backed by a remote CCNx object. The payload itself lives in
+    the store's RemoteCache, so every read sees the latest (or still-valid
+    stale) copy and no per-file refresh thread is needed.
+    '''
+    def __init__(self, name, fullpath, fid, cache):
+        super(RemoteFileHandle, self).__init__(name, fullpath, 0, fid)
+        self.cache = cache
 
     def load(self):
-        self.data, self.expiry = self.client.volatile_get(name)
-        if data != None:
-            self.size = len(data)
-
-            # Start a timer to refresh the content when the expiration time is up
-            timer = Timer(self.expiry, self.load)
-            timer.start()
+        payload = self.cache.get(self.name)
+        with self.lock.writing():
+            self.size = len(payload) if payload != None else 0
         return self
+
+    def unload(self):
+        pass
+
+    def fsync(self):
+        ''' Remote objects are read-only; there is nothing to write back.
+        '''
+        pass
+
+    def read(self, offset, length):
+        payload = self.cache.get(self.name)
+        if payload == None:
+            return None
+        # The payload may have been refreshed since load(). Assigning the
+        # size is atomic, so readers need not take the write lock for it.
+        self.size = len(payload)
+        with self.lock.reading():
+            if offset >= len(payload):
+                return None
+            return payload[offset:offset + length]
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import time
+import heapq
+import Queue
+import random
+import threading
+
+from Messages import *
+from SegmentFetcher import *
+
+INTEREST_LIFETIME = 4.0 # seconds, the CCNx default
+
+class LoopbackPortal(object):
+    ''' An in-process stand-in for a portal and the network behind it.
+
+    Interests are answered from `content`, a dict of name -> payload, or by
+    calling `responder(name)` (e.g. Publisher.lookup), after a simulated
+    round trip of `rtt` seconds; a fraction `loss` of Interests is silently
+    dropped. It provides the same send_interest/receive_content
+    transport interface as CCNxClient, so fetchers can run with no forwarder.
+    '''
+    def __init__(self, content = None, rtt = 0.0, loss = 0.0, responder = None):
+        self.content = content if content is not None else {}
+        self.responder = responder or self.content.get
+        self.rtt = rtt
+        self.loss = loss
+        self.queue = []
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    def publish(self, name, payload, segment_size = SEGMENT_SIZE):
+        for index, segment in enumerate(split_segments(payload, segment_size)):
+            self.content[segment_name(name, index)] = segment
+
+    def send_interest(self, interest):
+        name = str(interest.name)
+        payload = self.responder(name)
+        if payload is None or random.random() < self.loss:
+            return
+        with self.cond:
+            self.seq += 1
+            # The payload may be a buffer (see PublishedFile.segment); what
+            # arrives is a copy, as off the wire.
+            heapq.heappush(self.queue, (time.time() + self.rtt, self.seq, ContentObject(Name(name), str(payload))))
+            self.cond.notify()
+
+    def cancel_interest(self, name):
+        pass
+
+    def receive_content(self, timeout = None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while True:
+                now = time.time()
+                if self.queue and self.queue[0][0] <= now:
+                    return heapq.heappop(self.queue)[2]
+                wait = None
+                if self.queue:
+                    wait = self.queue[0][0] - now
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self.cond.wait(wait)
+
+class FakeForwarder(object):
+    ''' An in-process stand-in for a CCNx forwarder.
+
+    Faces attach with connect(). A producer face listen()s on a prefix and
+    pulls Interests with receive_interest(); Interests are routed to the
+    longest matching prefix, duplicates for a name already in the PIT are
+    aggregated, and a reply() goes back to every face that asked.
+
+    A PIT entry lives for `interest_lifetime` seconds, like the Interest
+    that made it. A face that sends the same Interest again retransmits it
+    rather than being aggregated, and a face can cancel_interest() once it
+    stops waiting.
+    '''
+    def __init__(self, interest_lifetime = INTEREST_LIFETIME):
+        self.fib = {}
+        self.pit = {} # name -> [expiry, set of faces]
+        self.interest_lifetime = interest_lifetime
+        self.next_sweep = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return ForwarderFace(self)
+
+    def route(self, name):
+        segments = name.split("/")
+        for length in range(len(segments), 0, -1):
+            face = self.fib.get("/".join(segments[:length]))
+            if face is not None:
+                return face
+        return None
+
+    def sweep(self, now):
+        ''' Drop expired PIT entries. Must be called with the lock held.
+        '''
+        if now >= self.next_sweep:
+            for name in [name for name, (expiry, faces) in self.pit.items() if expiry <= now]:
+                del self.pit[name]
+            self.next_sweep = now + self.interest_lifetime
+
+    def forward_interest(self, face, interest):
+        name = str(interest.name)
+        now = time.time()
+        with self.lock:
+            self.sweep(now)
+            entry = self.pit.get(name)
+            if entry is not None and entry[0] > now and face not in entry[1]:
+                entry[0] = max(entry[0], now + self.interest_lifetime)
+                entry[1].add(face)
+                return
+            producer = self.route(name)
+            if producer is None:
+                return
+            if entry is None or entry[0] <= now:
+                entry = self.pit[name] = [0, set()]
+            entry[0] = now + self.interest_lifetime
+            entry[1].add(face)
+        producer.interests.put(interest)
+
+    def forward_content(self, content):
+        with self.lock:
+            expiry, faces = self.pit.pop(str(content.name), (0, ()))
+        if expiry <= time.time():
+            return # nobody is waiting any more
+        for face in faces:
+            face.contents.put(content)
+
+    def cancel(self, face, name):
+        with self.lock:
+            entry = self.pit.get(name)
+            if entry is not None:
+                entry[1].discard(face)
+                if not entry[1]:
+                    del self.pit[name]
+
+class ForwarderFace(object):
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.interests = Queue.Queue()
+        self.contents = Queue.Queue()
+
+    def send_interest(self, interest):
+        self.forwarder.forward_interest(self, interest)
+
+    def cancel_interest(self, name):
+        self.forwarder.cancel(self, str(name))
+
+    def receive_content(self, timeout = None):
+        try:
+            return self.contents.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    def listen(self, prefix):
+        with self.forwarder.lock:
+            self.forwarder.fib[str(prefix)] = self
+
+    def receive_interest(self, timeout = None):
+        try:
+            return self.interests.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    def reply(self, name, data):
+        self.forwarder.forward_content(ContentObject(Name(name), str(data)))
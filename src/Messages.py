@@ -0,0 +1,39 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+# The message types the segment fetcher, the loopback transports and the
+# request multiplexer build. They come from the PARC CCNx library when it is
+# installed; otherwise these minimal stand-ins, which carry just the fields
+# those modules use, let them run (and be tested) with no library at all.
+try:
+    from CCNx import Name, Interest, ContentObject
+except ImportError:
+    class Name(object):
+        def __init__(self, uri):
+            self.uri = str(uri)
+
+        def __str__(self):
+            return self.uri
+
+        def __repr__(self):
+            return "Name(%r)" % (self.uri)
+
+    class Interest(object):
+        def __init__(self, name, payload = None):
+            self.name = name
+            self.payload = payload
+
+        def getPayload(self):
+            return self.payload
+
+        def setPayload(self, payload):
+            self.payload = payload
+
+    class ContentObject(object):
+        def __init__(self, name, payload = None):
+            self.name = name
+            self.payload = payload
+
+        def getPayload(self):
+            return self.payload
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os
+import mmap
+import json
+import hashlib
+import threading
+
+from SegmentFetcher import *
+
+MANIFEST_SUFFIX = "manifest"
+
+def manifest_name(name):
+    return "%s/%s" % (name, MANIFEST_SUFFIX)
+
+class PublishedFile(object):
+    ''' A local file published as fixed-size segments. The file is mapped,
+    not read, and a segment is a buffer over the mapping, so serving one
+    copies nothing until the transport writes it out.
+    '''
+    def __init__(self, name, path, segment_size = SEGMENT_SIZE):
+        self.name = name
+        self.path = path
+        self.segment_size = segment_size
+        with open(path, "rb") as fh:
+            self.size = os.fstat(fh.fileno()).st_size
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if self.size else ""
+        # split_segments() semantics: always end with a short segment.
+        self.count = self.size // segment_size + 1
+        # The manifest always uses the default segment size, since consumers
+        # only learn the data segment size by reading it.
+        self.manifest = split_segments(json.dumps(self.build_manifest()))
+
+    def segment(self, index):
+        if index < 0 or index >= self.count:
+            return None
+        offset = index * self.segment_size
+        return buffer(self.map, offset, self.segment_size)
+
+    def build_manifest(self):
+        ''' A flat FLIC-style manifest: the name and SHA-256 digest of every
+        data segment, in order.
+        '''
+        entries = []
+        for index in range(self.count):
+            offset = index * self.segment_size
+            length = max(0, min(self.segment_size, self.size - offset))
+            digest = hashlib.sha256(buffer(self.map, offset, length) if length else "").hexdigest()
+            entries.append([segment_name(self.name, index), digest])
+        return {"name": self.name, "size": self.size, "segment_size": self.segment_size, "segments": entries}
+
+    def close(self):
+        # Segments handed out may still point into the mapping, so it is not
+        # closed here; it is unmapped once the last of them is dropped.
+        self.map = None
+
+class Publisher(object):
+    ''' Serves published files segment by segment. Data segments live at
+    <name>/chunk=N and the manifest, itself segmented, at
+    <name>/manifest/chunk=N. Every Interest is answered independently, so
+    any number of consumers can pull different segments of the same file.
+    '''
+    def __init__(self, client = None, segment_size = SEGMENT_SIZE):
+        self.client = client
+        self.segment_size = segment_size
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def publish_file(self, name, path):
+        published = PublishedFile(name, path, self.segment_size)
+        with self.lock:
+            old = self.files.pop(name, None)
+            self.files[name] = published
+        if old is not None:
+            old.close()
+        return published
+
+    def unpublish(self, name):
+        with self.lock:
+            published = self.files.pop(name, None)
+        if published is not None:
+            published.close()
+
+    def lookup(self, name):
+        ''' Return the payload answering an Interest for `name`, or None.
+        '''
+        name = str(name)
+        index = segment_index(name)
+        if index is None:
+            return None
+        base = name[:name.rindex("/")]
+        with self.lock:
+            published = self.files.get(base)
+            if published is not None:
+                return published.segment(index)
+            if base.endswith("/" + MANIFEST_SUFFIX):
+                published = self.files.get(base[:-len(MANIFEST_SUFFIX) - 1])
+                if published is not None and index < len(published.manifest):
+                    return published.manifest[index]
+        return None
+
+    def answer(self, name):
+        payload = self.lookup(name)
+        if payload is not None:
+            self.client.reply(str(name), payload)
+        return payload is not None
+
+    def serve_forever(self, prefix):
+        self.client.listen(prefix)
+        while True:
+            name, payload = self.client.receive()
+            if name is not None:
+                self.answer(name)
+
+    def push_file(self, name, path):
+        ''' Upload a file by pushing its manifest and then every segment as
+        Interest payloads.
+        '''
+        published = PublishedFile(name, path, self.segment_size)
+        try:
+            for index, segment in enumerate(published.manifest):
+                self.client.push(segment_name(manifest_name(name), index), segment)
+            for index in range(published.count):
+                self.client.push(segment_name(name, index), published.segment(index))
+        finally:
+            published.close()
+
+def fetch_manifest(transport, name, **window_options):
+    window_options.pop("segment_size", None)
+    return json.loads(WindowedFetcher(transport, **window_options).fetch(manifest_name(name)))
+
+def fetch_segments(transport, name, manifest, **window_options):
+    ''' Fetch every data segment `manifest` lists, each checked against its
+    digest.
+    '''
+    window_options.pop("segment_size", None)
+    digests = [digest for segment, digest in manifest["segments"]]
+    return WindowedFetcher(transport, manifest["segment_size"], **window_options).fetch(name, len(digests), digests)
+
+def fetch_file(transport, name, **window_options):
+    ''' Fetch a published file: first its manifest, then every data segment
+    it lists.
+    '''
+    return fetch_segments(transport, name, fetch_manifest(transport, name, **window_options), **window_options)
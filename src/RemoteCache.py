@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import time
+import Queue
+import threading
+import collections
+
+from common.Metrics import *
+from common.Trace import *
+
+DEFAULT_REMOTE_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_EXPIRY = 10.0
+
+class RemoteEntry(object):
+    __slots__ = ("payload", "expires", "size")
+
+    def __init__(self, payload, expires):
+        self.payload = payload
+        self.expires = expires
+        self.size = len(payload)
+
+class Flight(object):
+    ''' A fetch in progress that later callers for the same name wait on.
+    '''
+    def __init__(self):
+        self.event = threading.Event()
+        self.payload = None
+        self.error = None
+
+class RemoteCache(object):
+    ''' Remote objects keyed by CCNx name, with their expiry.
+
+    A fresh entry is returned as is. An expired entry is still returned, and
+    its name is queued for the single background worker to re-fetch. A miss
+    is fetched by the caller; concurrent misses for the same name wait on
+    that one fetch instead of sending their own Interests. Entries are
+    evicted least recently used first once `budget` bytes are held.
+
+    `fetch(name)` returns (payload, expiry in seconds), with payload None if
+    nothing answered. With a `disk` cache, misses are served from it first
+    and everything fetched is written through to it.
+    '''
+    def __init__(self, fetch, budget = DEFAULT_REMOTE_CACHE_BYTES, disk = None, metrics = NULL_METRICS):
+        self.fetch = fetch
+        self.budget = budget
+        self.disk = disk
+        self.metrics = metrics
+        self.entries = collections.OrderedDict()
+        self.used = 0
+        self.flights = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.worker = threading.Thread(target=self.refresh_loop, name="remote-refresh")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def get(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                self.entries[name] = self.entries.pop(name)
+                if entry.expires <= time.time():
+                    self.metrics.count("remote_cache.stale")
+                    self._schedule_refresh(name)
+                else:
+                    self.metrics.count("remote_cache.hits")
+                return entry.payload
+        self.metrics.count("remote_cache.misses")
+        return self.load(name)
+
+    def _schedule_refresh(self, name):
+        if name not in self.refreshing:
+            self.refreshing.add(name)
+            self.queue.put(name)
+
+    def load(self, name, refresh = False):
+        ''' Fetch `name`, sharing the fetch with anyone already waiting on it.
+        Unless refreshing, a copy on disk is used in place of the network.
+        '''
+        with self.lock:
+            flight = self.flights.get(name)
+            leader = flight is None
+            if leader:
+                flight = self.flights[name] = Flight()
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.payload
+
+        stale = False
+        try:
+            stored = self.disk.get(name) if self.disk is not None and not refresh else None
+            if stored is not None:
+                self.metrics.count("disk_cache.hits")
+                payload, expires = stored
+                self.put(name, payload, expires - time.time())
+                stale = expires <= time.time()
+            else:
+                with self.metrics.timing("remote.fetch"):
+                    payload, expiry = self.fetch(name)
+                if payload is None:
+                    self.metrics.count("remote.unanswered")
+                if payload is not None:
+                    self.put(name, payload, expiry)
+                    if self.disk is not None:
+                        self.disk.put(name, payload, time.time() + expiry)
+            flight.payload = payload
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[name]
+                if stale:
+                    self._schedule_refresh(name)
+            flight.event.set()
+        return payload
+
+    def put(self, name, payload, expiry = DEFAULT_EXPIRY):
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old is not None:
+                self.used -= old.size
+            entry = RemoteEntry(payload, time.time() + expiry)
+            self.entries[name] = entry
+            self.used += entry.size
+            self.evict()
+
+    def evict(self):
+        while self.used > self.budget and len(self.entries) > 1:
+            name, entry = self.entries.popitem(last=False)
+            self.used -= entry.size
+
+    def invalidate(self, name):
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is not None:
+                self.used -= entry.size
+
+    def refresh_loop(self):
+        while True:
+            name = self.queue.get()
+            if name is None:
+                return
+            try:
+                self.load(name, True)
+            except Exception as e:
+                TRACER.warn("refresh of %s failed: %s", name, e)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(name)
+
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import re
+import time
+import hashlib
+
+from Messages import *
+
+# A segmented object is published as <name>/chunk=0, <name>/chunk=1, ...
+# Every segment but the last carries exactly SEGMENT_SIZE bytes; the first
+# short (possibly empty) segment marks the end of the object.
+SEGMENT_SIZE = 4096
+CHUNK_PATTERN = re.compile(r"/chunk=(\d+)$")
+
+def segment_name(name, index):
+    return "%s/chunk=%d" % (name, index)
+
+def split_segments(payload, segment_size = SEGMENT_SIZE):
+    ''' Cut a payload into segments, ending with a short one.
+    '''
+    segments = [payload[offset:offset + segment_size] for offset in range(0, len(payload), segment_size)]
+    if not segments or len(segments[-1]) == segment_size:
+        segments.append("")
+    return segments
+
+class FetchTimeout(Exception):
+    pass
+
+def segment_index(name, prefix = None):
+    ''' The chunk number of a segment name, or None. With `prefix`, only a
+    segment of the object `prefix` itself counts.
+    '''
+    name = str(name)
+    match = CHUNK_PATTERN.search(name)
+    if match is None:
+        return None
+    index = int(match.group(1))
+    expected = segment_name(prefix, index) if prefix is not None else name
+    # Compared as written and as the CCNx library prints names.
+    if name != expected and name != str(Name(expected)):
+        return None
+    return index
+
+class WindowedFetcher(object):
+    ''' Fetch a segmented object with a sliding window of Interests.
+
+    Up to `window` Interests for consecutive segments are kept in flight.
+    The window grows additively as segments arrive (doubling per round trip
+    until the first loss) and is halved when an Interest times out. The
+    retransmission timeout follows RFC 6298 smoothed RTT estimates.
+
+    The transport must provide send_interest(interest) and
+    receive_content(timeout), the latter returning a ContentObject or None.
+    '''
+    def __init__(self, transport, segment_size = SEGMENT_SIZE, initial_window = 2, max_window = 64,
+                 max_retries = 8, rto = 1.0, min_rto = 0.05, max_rto = 8.0):
+        self.transport = transport
+        self.segment_size = segment_size
+        self.window = float(initial_window)
+        self.threshold = float(max_window)
+        self.max_window = max_window
+        self.max_retries = max_retries
+        self.rto = rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.last_decrease = 0
+
+    def sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def grow(self):
+        if self.window < self.threshold:
+            self.window += 1
+        else:
+            self.window += 1 / self.window
+        self.window = min(self.window, self.max_window)
+
+    def shrink(self, sent_at):
+        # Only react once per window of losses: segments sent before the
+        # previous decrease were already accounted for.
+        if sent_at >= self.last_decrease:
+            self.threshold = max(self.window / 2, 1)
+            self.window = self.threshold
+            self.rto = min(self.max_rto, self.rto * 2)
+            self.last_decrease = time.time()
+
+    def send(self, name, index):
+        self.transport.send_interest(Interest(Name(segment_name(name, index))))
+        return time.time()
+
+    def fetch(self, name, count = None, digests = None):
+        ''' Return the reassembled payload of `name`. If `count` is known the
+        fetch stops after that many segments; otherwise it stops at the first
+        short segment. With `digests` (hex SHA-256 per segment, e.g. from a
+        manifest), a segment that does not match is discarded and re-fetched.
+        '''
+        segments = {}
+        pending = {} # index -> (time sent, retransmissions)
+        end = count
+        next_index = 0
+
+        while end is None or pending or next_index < end:
+            while len(pending) < int(self.window) and (end is None or next_index < end):
+                pending[next_index] = (self.send(name, next_index), 0)
+                next_index += 1
+
+            now = time.time()
+            for index, (sent_at, retries) in sorted(pending.items()):
+                if now - sent_at < self.rto:
+                    continue
+                if retries >= self.max_retries:
+                    raise FetchTimeout("Timed out fetching %s" % (segment_name(name, index)))
+                self.shrink(sent_at)
+                pending[index] = (self.send(name, index), retries + 1)
+
+            deadline = min(sent_at for sent_at, retries in pending.values()) + self.rto
+            response = self.transport.receive_content(max(0, deadline - time.time()))
+            if response is None:
+                continue
+
+            index = segment_index(response.name, name)
+            if index not in pending:
+                continue # another object's, duplicate or stale
+            payload = response.getPayload() or ""
+            if digests is not None and hashlib.sha256(payload).hexdigest() != digests[index]:
+                continue
+            sent_at, retries = pending.pop(index)
+            if retries == 0:
+                self.sample_rtt(time.time() - sent_at)
+            segments[index] = payload
+            self.grow()
+
+            if len(payload) < self.segment_size and (end is None or index + 1 < end):
+                end = index + 1
+                for extra in [i for i in pending if i >= end]:
+                    del pending[extra]
+
+        return "".join(segments[index] for index in range(end))